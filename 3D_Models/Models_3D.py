@@ -1,6 +1,124 @@
 import numpy
 import moments
 import time
+from collections import OrderedDict
+
+
+#Cache of the parameter-independent start of the models, keyed on sample sizes
+_split_cache = {}
+
+def _split_spectrum(ns, nsplits):
+    """
+    Equilibrium spectrum for sum(ns) samples after its first nsplits splits.
+    nsplits = 1 gives pop 1 and (2,3), nsplits = 2 gives pops 1, 2 and 3.
+    This depends only on ns, so it is computed once per set of sample sizes
+    and every call gets a fresh copy that is safe to integrate in place.
+    """
+    key = (tuple(int(n) for n in ns), nsplits)
+    if key not in _split_cache:
+        sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
+        fs = moments.Spectrum(sts)
+        fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
+        if nsplits >= 2:
+            fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+        _split_cache[key] = fs
+    return _split_cache[key].copy()
+
+
+#Preallocated float migration matrices and size vectors, keyed on (model name, epoch).
+#They are refilled in place on every call; integrate copies them, so reusing them is safe.
+_buffers = {}
+_size_buffers = {}
+
+def _positions(npops, pairs):
+    """
+    Flat positions (row * npops + column) of the (row, column) pairs of a migration matrix,
+    the scatter indices used to fill a preallocated matrix.
+    """
+    return numpy.array([i * npops + j for i, j in pairs], dtype=numpy.intp)
+
+def _mig_matrix(key, npops, index=(), values=()):
+    """
+    Preallocated npops x npops float migration matrix for key, with the flat positions
+    in index set to values (in the same order). Positions not in index stay 0, so a
+    matrix without index means no migration.
+    """
+    buf = _buffers.get(key)
+    if buf is None:
+        matrix = numpy.zeros((npops, npops))
+        buf = _buffers[key] = (matrix, matrix.reshape(-1))
+    if len(index):
+        buf[1][index] = values
+    return buf[0]
+
+def _sizes(key, values):
+    """
+    Preallocated float vector of population sizes for key, filled with values.
+    """
+    buf = _size_buffers.get(key)
+    if buf is None:
+        buf = _size_buffers[key] = numpy.zeros(len(values))
+    buf[:] = values
+    return buf
+
+#Scatter indices of the migration rates, in matrix reading order (row by row)
+_PAIR_2 = _positions(2, [(0, 1), (1, 0)])
+_ADJ_3 = _positions(3, [(0, 1), (1, 0), (1, 2), (2, 1)])
+_PAIR_23 = _positions(3, [(1, 2), (2, 1)])
+_ALL_3 = _positions(3, [(0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1)])
+
+
+#Spectra after the leading epochs of the split models, keyed on the sample sizes and
+#exactly the parameters those epochs consume, least recently used first.
+#Bounded to _EPOCH_CACHE_SIZE spectra and _EPOCH_CACHE_BYTES of memory.
+_epoch_cache = OrderedDict()
+_EPOCH_CACHE_SIZE = 64
+_EPOCH_CACHE_BYTES = 128 * 1024**2
+
+def _epoch_lookup(key):
+    """
+    Copy of the cached spectrum for key (safe to integrate in place), or None.
+    """
+    fs = _epoch_cache.pop(key, None)
+    if fs is None:
+        return None
+    _epoch_cache[key] = fs
+    return fs.copy()
+
+def _epoch_store(key, fs):
+    """
+    Cache a copy of fs for key, dropping the least recently used spectra beyond the bounds.
+    """
+    _epoch_cache[key] = fs.copy()
+    while len(_epoch_cache) > 1 and (len(_epoch_cache) > _EPOCH_CACHE_SIZE or
+            sum(x.data.nbytes for x in _epoch_cache.values()) > _EPOCH_CACHE_BYTES):
+        _epoch_cache.popitem(last=False)
+
+def clear_caches():
+    """
+    Empty the caches of the models (the parameter-independent start and the ancestral
+    epochs), ex. to time model calls from a cold start.
+    """
+    _split_cache.clear()
+    _epoch_cache.clear()
+
+def _ancestral_3D(ns, nu1, nuA, mA, T1, dt_fac=None):
+    """
+    Spectrum of the split models after their first epoch (pop 1 and (2,3) with sizes nu1
+    and nuA, symmetric migration mA, for time T1) and the split between 2 and 3, ready for
+    the last epoch. It is cached on these parameters, so optimizer steps that only change
+    the parameters of the last epoch do not integrate the first one again.
+    """
+    key = (tuple(int(n) for n in ns), float(nu1), float(nuA), float(mA), float(T1), dt_fac)
+    fs = _epoch_lookup(key)
+    if fs is None:
+        fs = _split_spectrum(ns, 1)
+        sym_mig = _mig_matrix(("ancestral", 1), 2, _PAIR_2, (mA, mA))
+        kwargs = {} if dt_fac is None else {"dt_fac": dt_fac}
+        fs.integrate(_sizes(("ancestral", 1), (nu1, nuA)), T1, m=sym_mig, **kwargs)
+        fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+        _epoch_store(key, fs)
+    return fs
 
 
 #Simultaneous Split Models
@@ -17,12 +135,9 @@ def sim_split_no_mig(params, ns):
 	"""
     #4 parameters
     nu1,nu2,nu3, T1 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-    nomig = numpy.array([[0, 0], [0, 0]])
-    fs.integrate([nu1, nu2, nu3], T1, m=nomig, dt_fac=0.01)
+    fs = _split_spectrum(ns, 2)
+    nomig = _mig_matrix(("sim_split_no_mig", 1), 3)
+    fs.integrate(_sizes(("sim_split_no_mig", 1), (nu1, nu2, nu3)), T1, m=nomig, dt_fac=0.01)
     return fs
 
 def sim_split_sym_mig_adjacent(params, ns):
@@ -37,12 +152,9 @@ def sim_split_sym_mig_adjacent(params, ns):
 	"""
     #6 parameters
     nu1,nu2,nu3,m12,m23,T1 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-    sym_mig = numpy.array([[0, m12, 0], [m12, 0, m23], [0, m23, 0]])
-    fs.integrate([nu1, nu2, nu3], T1, m=sym_mig, dt_fac=0.01)
+    fs = _split_spectrum(ns, 2)
+    sym_mig = _mig_matrix(("sim_split_sym_mig_adjacent", 1), 3, _ADJ_3, (m12, m12, m23, m23))
+    fs.integrate(_sizes(("sim_split_sym_mig_adjacent", 1), (nu1, nu2, nu3)), T1, m=sym_mig, dt_fac=0.01)
     return fs
 
 def sim_split_asym_mig_adjacent(params, ns):
@@ -59,14 +171,9 @@ def sim_split_asym_mig_adjacent(params, ns):
     """
     # 8 parameters
     nu1, nu2, nu3, m12, m21, m23, m32, T1 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-    asym_mig_adj = numpy.array([[0, m12, 0],
-                              [m21, 0, m23],
-                              [0, m32, 0]])
-    fs.integrate([nu1, nu2, nu3], T1, m=asym_mig_adj, dt_fac=0.01)
+    fs = _split_spectrum(ns, 2)
+    asym_mig_adj = _mig_matrix(("sim_split_asym_mig_adjacent", 1), 3, _ADJ_3, (m12, m21, m23, m32))
+    fs.integrate(_sizes(("sim_split_asym_mig_adjacent", 1), (nu1, nu2, nu3)), T1, m=asym_mig_adj, dt_fac=0.01)
     return fs
 
 def sim_split_sym_mig_all(params, ns):
@@ -85,14 +192,9 @@ def sim_split_sym_mig_all(params, ns):
 	"""
     #7 parameters
     nu1, nu2, nu3, m12, m13, m23, T1 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-    sym_mig_all = numpy.array([[0, m12, m13],
-                             [m12, 0, m23],
-                             [m13, m23, 0]])
-    fs.integrate([nu1, nu2, nu3], T1, m=sym_mig_all, dt_fac=0.01)
+    fs = _split_spectrum(ns, 2)
+    sym_mig_all = _mig_matrix(("sim_split_sym_mig_all", 1), 3, _ALL_3, (m12, m13, m12, m23, m13, m23))
+    fs.integrate(_sizes(("sim_split_sym_mig_all", 1), (nu1, nu2, nu3)), T1, m=sym_mig_all, dt_fac=0.01)
     return fs
 
 def sim_split_asym_mig_all(params, ns):
@@ -112,14 +214,9 @@ def sim_split_asym_mig_all(params, ns):
     #10 parameters
     nu1, nu2, nu3, m12, m21, m13, m31, m23, m32, T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-    asym_mig_all = numpy.array([[0, m12, m13],
-                               [m21, 0, m23],
-                               [m31, m32, 0]])
-    fs.integrate([nu1, nu2, nu3], T1, m=asym_mig_all, dt_fac=0.01)
+    fs = _split_spectrum(ns, 2)
+    asym_mig_all = _mig_matrix(("sim_split_asym_mig_all", 1), 3, _ALL_3, (m12, m13, m21, m23, m31, m32))
+    fs.integrate(_sizes(("sim_split_asym_mig_all", 1), (nu1, nu2, nu3)), T1, m=asym_mig_all, dt_fac=0.01)
     return fs
 
 
@@ -141,21 +238,12 @@ def split_nomig(params, ns):
     # 7 parameters
     nu1, nuA, nu2, nu3, mA, T1, T2 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-
-    sym_mig = numpy.array([[0, mA], [mA, 0]])
-
-    fs.integrate([nu1, nuA], T1, m=sym_mig)
-
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+    #the first epoch and the split between 2 and 3 are cached on (nu1, nuA, mA, T1)
+    fs = _ancestral_3D(ns, nu1, nuA, mA, T1)
     
-    nomig = numpy.array([[0,0,0],
-                         [0,0,0],
-                         [0,0,0]])
+    nomig = _mig_matrix(("split_nomig", 2), 3)
 
-    fs.integrate([nu1, nu2, nu3], T2, m=nomig)
+    fs.integrate(_sizes(("split_nomig", 2), (nu1, nu2, nu3)), T2, m=nomig)
 
     return fs
 
@@ -180,21 +268,12 @@ def split_sym_mig_all(params, ns):
     # 10 parameters
     nu1, nuA, nu2, nu3, mA, m12, m23, m13, T1, T2 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-
-    sym_mig_1 = numpy.array([[0, mA], [mA, 0]])
-
-    fs.integrate([nu1, nuA], T1, m=sym_mig_1)
-
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+    #the first epoch and the split between 2 and 3 are cached on (nu1, nuA, mA, T1)
+    fs = _ancestral_3D(ns, nu1, nuA, mA, T1)
 
-    sym_mig_2 = numpy.array([[0, m12, m13],
-                             [m12, 0, m23],
-                             [m13, m23, 0]])
+    sym_mig_2 = _mig_matrix(("split_sym_mig_all", 2), 3, _ALL_3, (m12, m13, m12, m23, m13, m23))
 
-    fs.integrate([nu1, nu2, nu3], T2, m=sym_mig_2)
+    fs.integrate(_sizes(("split_sym_mig_all", 2), (nu1, nu2, nu3)), T2, m=sym_mig_2)
 
     return fs
 
@@ -218,21 +297,12 @@ def split_asym_mig_all(params, ns):
     # 13 parameters
     nu1, nuA, nu2, nu3, mA, m12, m13, m21, m23, m31, m32, T1, T2 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
+    #the first epoch and the split between 2 and 3 are cached on (nu1, nuA, mA, T1)
+    fs = _ancestral_3D(ns, nu1, nuA, mA, T1, dt_fac=0.01)
 
-    sym_mig_1 = numpy.array([[0, mA], [mA, 0]])
+    sym_mig_2 = _mig_matrix(("split_asym_mig_all", 2), 3, _ALL_3, (m12, m13, m21, m23, m31, m32))
 
-    fs.integrate([nu1, nuA], T1, m=sym_mig_1, dt_fac=0.01)
-
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
-
-    sym_mig_2 = numpy.array([[0, m12, m13],
-                             [m21, 0, m23],
-                             [m31, m32, 0]])
-
-    fs.integrate([nu1, nu2, nu3], T2, m=sym_mig_2, dt_fac=0.01)
+    fs.integrate(_sizes(("split_asym_mig_all", 2), (nu1, nu2, nu3)), T2, m=sym_mig_2, dt_fac=0.01)
 
     return fs
 
@@ -254,19 +324,12 @@ def split_symmig_adjacent(params, ns):
        """
     # 8 parameters
     nu1, nuA, nu2, nu3, mA, m23, T1, T2 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-
-    sym_mig_1 = numpy.array([[0, mA], [mA, 0]])
-
-    fs.integrate([nu1, nuA], T1, m=sym_mig_1, dt_fac=0.01)
+    #the first epoch and the split between 2 and 3 are cached on (nu1, nuA, mA, T1)
+    fs = _ancestral_3D(ns, nu1, nuA, mA, T1, dt_fac=0.01)
 
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+    sym_mig_2 = _mig_matrix(("split_symmig_adjacent", 2), 3, _PAIR_23, (m23, m23))
 
-    sym_mig_2 = numpy.array([[0, 0, 0], [0, 0, m23], [0, m23, 0]])
-
-    fs.integrate([nu1, nu2, nu3], T2, m=sym_mig_2, dt_fac=0.01)
+    fs.integrate(_sizes(("split_symmig_adjacent", 2), (nu1, nu2, nu3)), T2, m=sym_mig_2, dt_fac=0.01)
 
     return fs
 
@@ -279,21 +342,12 @@ def split_asymmig_adjacent(params, ns):
        """
     # 9 parameters
     nu1, nuA, nu2, nu3, mAB, m23, m32, T1, T2 = params
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2])
-
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-
-    fs.integrate([nu1, nuA], T1, m=sym_mig_1, dt_fac=0.01)
-
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+    #the first epoch and the split between 2 and 3 are cached on (nu1, nuA, mAB, T1)
+    fs = _ancestral_3D(ns, nu1, nuA, mAB, T1, dt_fac=0.01)
 
-    asym_mig_2 = numpy.array([[0, 0, 0],
-                              [0, 0, m23],
-                              [0, m32, 0]])
+    asym_mig_2 = _mig_matrix(("split_asymmig_adjacent", 2), 3, _PAIR_23, (m23, m32))
 
-    fs.integrate([nu1, nu2, nu3], T2, m=asym_mig_2, dt_fac=0.01)
+    fs.integrate(_sizes(("split_asymmig_adjacent", 2), (nu1, nu2, nu3)), T2, m=asym_mig_2, dt_fac=0.01)
 
     return fs
 
@@ -1,5 +1,137 @@
 import moments
 import numpy
+from collections import OrderedDict
+
+#Cache of the parameter-independent start of the models, keyed on sample sizes
+_split_cache = {}
+
+def _split_spectrum(ns, nsplits):
+    """
+    Equilibrium spectrum for sum(ns) samples after its first nsplits splits.
+    nsplits = 1 gives pop 1 and (2,3,4), nsplits = 2 gives pops 1, 2 and (3,4),
+    nsplits = 3 gives pops 1, 2, 3 and 4.
+    This depends only on ns, so it is computed once per set of sample sizes
+    and every call gets a fresh copy that is safe to integrate in place.
+    """
+    key = (tuple(int(n) for n in ns), nsplits)
+    if key not in _split_cache:
+        sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
+        fs = moments.Spectrum(sts)
+        fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
+        if nsplits >= 2:
+            fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
+        if nsplits >= 3:
+            fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+        _split_cache[key] = fs
+    return _split_cache[key].copy()
+
+
+#Preallocated float migration matrices and size vectors, keyed on (model name, epoch).
+#They are refilled in place on every call; integrate copies them, so reusing them is safe.
+_buffers = {}
+_size_buffers = {}
+
+def _positions(npops, pairs):
+    """
+    Flat positions (row * npops + column) of the (row, column) pairs of a migration matrix,
+    the scatter indices used to fill a preallocated matrix.
+    """
+    return numpy.array([i * npops + j for i, j in pairs], dtype=numpy.intp)
+
+def _mig_matrix(key, npops, index=(), values=()):
+    """
+    Preallocated npops x npops float migration matrix for key, with the flat positions
+    in index set to values (in the same order). Positions not in index stay 0, so a
+    matrix without index means no migration.
+    """
+    buf = _buffers.get(key)
+    if buf is None:
+        matrix = numpy.zeros((npops, npops))
+        buf = _buffers[key] = (matrix, matrix.reshape(-1))
+    if len(index):
+        buf[1][index] = values
+    return buf[0]
+
+def _sizes(key, values):
+    """
+    Preallocated float vector of population sizes for key, filled with values.
+    """
+    buf = _size_buffers.get(key)
+    if buf is None:
+        buf = _size_buffers[key] = numpy.zeros(len(values))
+    buf[:] = values
+    return buf
+
+#Scatter indices of the migration rates, in matrix reading order (row by row)
+_PAIR_2 = _positions(2, [(0, 1), (1, 0)])
+_ALL_3 = _positions(3, [(0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1)])
+_ALL_4 = _positions(4, [(i, j) for i in range(4) for j in range(4) if i != j])
+_BARRIER_4 = _positions(4, [(0, 1), (1, 0), (2, 3), (3, 2)])
+#the simultaneous split barrier models put the rates of pops 3 and 4 on the diagonal
+_SIM_BARRIER_4 = _positions(4, [(0, 1), (1, 0), (2, 2), (3, 3)])
+
+
+#Spectra after the leading epochs of the split models, keyed on the sample sizes and
+#exactly the parameters those epochs consume, least recently used first.
+#Bounded to _EPOCH_CACHE_SIZE spectra and _EPOCH_CACHE_BYTES of memory.
+_epoch_cache = OrderedDict()
+_EPOCH_CACHE_SIZE = 64
+_EPOCH_CACHE_BYTES = 256 * 1024**2
+
+def _epoch_lookup(key):
+    """
+    Copy of the cached spectrum for key (safe to integrate in place), or None.
+    """
+    fs = _epoch_cache.pop(key, None)
+    if fs is None:
+        return None
+    _epoch_cache[key] = fs
+    return fs.copy()
+
+def _epoch_store(key, fs):
+    """
+    Cache a copy of fs for key, dropping the least recently used spectra beyond the bounds.
+    """
+    _epoch_cache[key] = fs.copy()
+    while len(_epoch_cache) > 1 and (len(_epoch_cache) > _EPOCH_CACHE_SIZE or
+            sum(x.data.nbytes for x in _epoch_cache.values()) > _EPOCH_CACHE_BYTES):
+        _epoch_cache.popitem(last=False)
+
+def clear_caches():
+    """
+    Empty the caches of the models (the parameter-independent start and the ancestral
+    epochs), ex. to time model calls from a cold start.
+    """
+    _split_cache.clear()
+    _epoch_cache.clear()
+
+def _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2):
+    """
+    Spectrum of the split models after their two ancestral epochs and the split
+    between pops 3 and 4, ready for the last epoch:
+    epoch 1: pops A and B (B becomes pop 1) with sizes nuA and nuB, migration mAB, for time T1,
+    then pop 2 splits from A,
+    epoch 2: pops A, B and C with sizes nuA, nuB and nuC, migration mAB, mAC and mBC, for time T2.
+    Both epochs are cached on the parameters consumed up to their end, so optimizer steps
+    that only change later parameters do not integrate them again.
+    """
+    key_1 = (tuple(int(n) for n in ns), float(nuA), float(nuB), float(mAB), float(T1))
+    key_2 = key_1 + (float(nuC), float(mAC), float(mBC), float(T2))
+    fs = _epoch_lookup(key_2)
+    if fs is not None:
+        return fs
+    fs = _epoch_lookup(key_1)
+    if fs is None:
+        fs = _split_spectrum(ns, 1)
+        sym_mig_1 = _mig_matrix(("ancestral", 1), 2, _PAIR_2, (mAB, mAB))
+        fs.integrate(_sizes(("ancestral", 1), (nuA, nuB)), T1, m=sym_mig_1)
+        fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
+        _epoch_store(key_1, fs)
+    sym_mig_2 = _mig_matrix(("ancestral", 2), 3, _ALL_3, (mAB, mAC, mAB, mBC, mAC, mBC))
+    fs.integrate(_sizes(("ancestral", 2), (nuA, nuB, nuC)), T2, m=sym_mig_2)
+    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    _epoch_store(key_2, fs)
+    return fs
 
 ### Simultaneous Split Models ###
 
@@ -18,18 +150,11 @@ def sim_split_nomig_4D(params, ns):
 
     nu1, nu2, nu3, nu4 , T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] +ns[3])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    fs = _split_spectrum(ns, 3)
 
-    no_mig = numpy.array([[0, 0, 0, 0],
-                             [0, 0, 0, 0],
-                             [0, 0, 0, 0],
-                             [0, 0, 0, 0]])
+    no_mig = _mig_matrix(("sim_split_nomig_4D", 1), 4)
 
-    fs.integrate([nu1, nu2, nu3, nu4], T1, m=no_mig)
+    fs.integrate(_sizes(("sim_split_nomig_4D", 1), (nu1, nu2, nu3, nu4)), T1, m=no_mig)
 
     return fs
 
@@ -51,18 +176,12 @@ def sim_split_all_sym_mig_4D(params, ns):
 
     nu1, nu2, nu3, nu4, m12, m13, m14, m23, m24, m34, T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] +ns[3])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    fs = _split_spectrum(ns, 3)
 
-    sym_mig = numpy.array([[0, m12, m13, m14],
-                             [m12, 0, m23, m24],
-                             [m13, m23, 0, m34],
-                             [m14, m24, m34, 0  ]])
+    sym_mig = _mig_matrix(("sim_split_all_sym_mig_4D", 1), 4, _ALL_4,
+                          (m12, m13, m14, m12, m23, m24, m13, m23, m34, m14, m24, m34))
 
-    fs.integrate([nu1, nu2, nu3, nu4], T1, m=sym_mig)
+    fs.integrate(_sizes(("sim_split_all_sym_mig_4D", 1), (nu1, nu2, nu3, nu4)), T1, m=sym_mig)
 
     return fs
 
@@ -87,18 +206,12 @@ def sim_split_all_asym_mig_4D(params, ns):
 
     nu1, nu2, nu3, nu4, m12, m13, m14, m21, m23, m24, m31, m32, m34, m41, m42, m43, T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] +ns[3])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    fs = _split_spectrum(ns, 3)
 
-    asym_mig = numpy.array([[0, m12, m13, m14],
-                             [m21, 0, m23, m24],
-                             [m31, m32, 0, m34],
-                             [m41, m42, m43, 0  ]])
+    asym_mig = _mig_matrix(("sim_split_all_asym_mig_4D", 1), 4, _ALL_4,
+                           (m12, m13, m14, m21, m23, m24, m31, m32, m34, m41, m42, m43))
 
-    fs.integrate([nu1, nu2, nu3, nu4], T1, m=asym_mig)
+    fs.integrate(_sizes(("sim_split_all_asym_mig_4D", 1), (nu1, nu2, nu3, nu4)), T1, m=asym_mig)
 
     return fs
 
@@ -110,17 +223,10 @@ def sim_split_sym_mig_barrier_4D(params, ns):
 
     nu1, nu2, nu3, nu4, m12, m34, T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] +ns[3])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
-    sym_mig_2 = numpy.array([[0, m12, 0,0],
-			     [m12, 0, 0, 0],
-                             [0, 0, m34,0],
-                             [0, 0, 0,m34]])
+    fs = _split_spectrum(ns, 3)
+    sym_mig_2 = _mig_matrix(("sim_split_sym_mig_barrier_4D", 1), 4, _SIM_BARRIER_4, (m12, m12, m34, m34))
 
-    fs.integrate([nu1, nu2, nu3, nu4], T1, m=sym_mig_2)
+    fs.integrate(_sizes(("sim_split_sym_mig_barrier_4D", 1), (nu1, nu2, nu3, nu4)), T1, m=sym_mig_2)
 
     return fs
 
@@ -132,17 +238,10 @@ def sim_split_asym_mig_barrier_4D(params, ns):
 
     nu1, nu2, nu3, nu4, m12, m21, m34, m43, T1 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] +ns[3])
-    fs = moments.Spectrum(sts)
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
-    asym_mig_2 = numpy.array([[0, m12, 0, 0],
-                             [m21, 0, 0, 0],
-                             [0, 0, m34, 0  ],
-                             [0, 0, 0, m43  ]])
+    fs = _split_spectrum(ns, 3)
+    asym_mig_2 = _mig_matrix(("sim_split_asym_mig_barrier_4D", 1), 4, _SIM_BARRIER_4, (m12, m21, m34, m43))
 
-    fs.integrate([nu1, nu2, nu3, nu4], T1, m=asym_mig_2)
+    fs.integrate(_sizes(("sim_split_asym_mig_barrier_4D", 1), (nu1, nu2, nu3, nu4)), T1, m=asym_mig_2)
 
     return fs
 
@@ -159,35 +258,17 @@ def split_sym_mig_4D(params, ns):
     # 19 Parameters 
     nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m13, m14, m23, m24, m34, T1, T2, T3 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
-    fs = moments.Spectrum(sts)
-    # split S1 from the other populations, will result in [A,B], A will eventually become S1 
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
- 
-    # Symmetric migration between ancestral populations 
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-    
-    fs.integrate([nuA, nuB], T1, m=sym_mig_1)
-    
-    # the current order is [A,B], B = S1
-    # Now we will split S2 from population A
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    sym_mig_2 = numpy.array([[0, mAB, mAC],
-                             [mAB, 0, mBC],
-                             [mAC, mBC, 0]])
-    fs.integrate([nuA, nuB, nuC], T2, m=sym_mig_2) 
-   
-    # Split the E and West Pops 
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    # split S1 from the other populations, will result in [A,B], A will eventually become S1,
+    # then split S2 from population A, and split the E and West Pops;
+    # the two ancestral epochs are cached on (nuA, nuB, mAB, T1) and (nuC, mAC, mBC, T2)
+    fs = _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2)
 
  
-    sym_mig_3 = numpy.array([[0, m12, m13, m14],
-                             [m12, 0, m23, m24],
-                             [m13, m23, 0, m34  ],
-                             [m14, m24, m34, 0  ]])
+    sym_mig_3 = _mig_matrix(("split_sym_mig_4D", 3), 4, _ALL_4,
+                            (m12, m13, m14, m12, m23, m24, m13, m23, m34, m14, m24, m34))
 
     # and now the final time epoch is integrated:
-    fs.integrate([nu1, nu2, nu3, nu4], T3, m=sym_mig_3)
+    fs.integrate(_sizes(("split_sym_mig_4D", 3), (nu1, nu2, nu3, nu4)), T3, m=sym_mig_3)
     
     return fs
 
@@ -199,35 +280,17 @@ def split_asym_mig_all_4D(params, ns):
         #25 Parameters 
     nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m13, m14, m21, m23, m24, m31, m32, m34, m41, m42, m43, T1, T2, T3 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
-    fs = moments.Spectrum(sts)
-    # split S1 from the other populations, will result in [A,B], A will eventually become S1 
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
- 
-    # Symmetric migration between ancestral populations 
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-    
-    fs.integrate([nuA, nuB], T1, m=sym_mig_1)
-    
-    # the current order is [A,B], B = S1
-    # Now we will split S2 from population A
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    sym_mig_2 = numpy.array([[0, mAB, mAC],
-                             [mAB, 0, mBC],
-                             [mAC, mBC, 0]])
-    fs.integrate([nuA, nuB, nuC], T2, m=sym_mig_2) 
-   
-    # Split the E and West Pops 
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    # split S1 from the other populations, will result in [A,B], A will eventually become S1,
+    # then split S2 from population A, and split the E and West Pops;
+    # the two ancestral epochs are cached on (nuA, nuB, mAB, T1) and (nuC, mAC, mBC, T2)
+    fs = _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2)
 
  
-    asym_mig = numpy.array([[0, m12, m13, m14],
-                             [m21, 0, m23, m24],
-                             [m31, m32, 0, m34  ],
-                             [m41, m42, m43, 0  ]])
+    asym_mig = _mig_matrix(("split_asym_mig_all_4D", 3), 4, _ALL_4,
+                           (m12, m13, m14, m21, m23, m24, m31, m32, m34, m41, m42, m43))
 
     # and now the final time epoch is integrated:
-    fs.integrate([nu1, nu2, nu3, nu4], T3, m=asym_mig)
+    fs.integrate(_sizes(("split_asym_mig_all_4D", 3), (nu1, nu2, nu3, nu4)), T3, m=asym_mig)
     
     return fs
 
@@ -238,35 +301,16 @@ def split_nomig_4D(params, ns):
         # 13 Parameters 
     nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, T1, T2, T3 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
-    fs = moments.Spectrum(sts)
-    # split S1 from the other populations, will result in [A,B], A will eventually become S1 
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
- 
-    # Symmetric migration between ancestral populations 
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-    
-    fs.integrate([nuA, nuB], T1, m=sym_mig_1)
-    
-    # the current order is [A,B], B = S1
-    # Now we will split S2 from population A
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    sym_mig_2 = numpy.array([[0, mAB, mAC],
-                             [mAB, 0, mBC],
-                             [mAC, mBC, 0]])
-    fs.integrate([nuA, nuB, nuC], T2, m=sym_mig_2) 
-   
-    # Split the E and West Pops 
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    # split S1 from the other populations, will result in [A,B], A will eventually become S1,
+    # then split S2 from population A, and split the E and West Pops;
+    # the two ancestral epochs are cached on (nuA, nuB, mAB, T1) and (nuC, mAC, mBC, T2)
+    fs = _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2)
 
  
-    no_mig = numpy.array([[0, 0, 0, 0],
-                             [0, 0, 0, 0],
-                             [0, 0, 0, 0  ],
-                             [0, 0, 0, 0  ]])
+    no_mig = _mig_matrix(("split_nomig_4D", 3), 4)
 
     # and now the final time epoch is integrated:
-    fs.integrate([nu1, nu2, nu3, nu4], T3, m=no_mig)
+    fs.integrate(_sizes(("split_nomig_4D", 3), (nu1, nu2, nu3, nu4)), T3, m=no_mig)
     
     return fs
 
@@ -277,35 +321,16 @@ def split_symmig_barrier_4D(params, ns):
         # 15 Parameters 
     nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m34, T1, T2, T3 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
-    fs = moments.Spectrum(sts)
-    # split S1 from the other populations, will result in [A,B], A will eventually become S1 
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
- 
-    # Symmetric migration between ancestral populations 
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-    
-    fs.integrate([nuA, nuB], T1, m=sym_mig_1)
-    
-    # the current order is [A,B], B = S1
-    # Now we will split S2 from population A
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    sym_mig_2 = numpy.array([[0, mAB, mAC],
-                             [mAB, 0, mBC],
-                             [mAC, mBC, 0]])
-    fs.integrate([nuA, nuB, nuC], T2, m=sym_mig_2) 
-   
-    # Split the E and West Pops 
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    # split S1 from the other populations, will result in [A,B], A will eventually become S1,
+    # then split S2 from population A, and split the E and West Pops;
+    # the two ancestral epochs are cached on (nuA, nuB, mAB, T1) and (nuC, mAC, mBC, T2)
+    fs = _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2)
 
  
-    sym_migbarrier = numpy.array([[0, m12, 0, 0],
-                             [m12, 0, 0, 0],
-                             [0, 0, 0, m34  ],
-                             [0, 0, m34, 0  ]])
+    sym_migbarrier = _mig_matrix(("split_symmig_barrier_4D", 3), 4, _BARRIER_4, (m12, m12, m34, m34))
 
     # and now the final time epoch is integrated:
-    fs.integrate([nu1, nu2, nu3, nu4], T3, m=sym_migbarrier)
+    fs.integrate(_sizes(("split_symmig_barrier_4D", 3), (nu1, nu2, nu3, nu4)), T3, m=sym_migbarrier)
     
     return fs
 
@@ -316,35 +341,16 @@ def split_asymmig_barrier_4D(params, ns):
         # 17 Parameters 
     nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m21, m34, m43, T1, T2, T3 = params
 
-    sts = moments.LinearSystem_1D.steady_state_1D(ns[0] + ns[1] + ns[2] + ns[3])
-    fs = moments.Spectrum(sts)
-    # split S1 from the other populations, will result in [A,B], A will eventually become S1 
-    fs = moments.Manips.split_1D_to_2D(fs, ns[0], ns[1] + ns[2] + ns[3])
- 
-    # Symmetric migration between ancestral populations 
-    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
-    
-    fs.integrate([nuA, nuB], T1, m=sym_mig_1)
-    
-    # the current order is [A,B], B = S1
-    # Now we will split S2 from population A
-    fs = moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2] + ns[3])
-    sym_mig_2 = numpy.array([[0, mAB, mAC],
-                             [mAB, 0, mBC],
-                             [mAC, mBC, 0]])
-    fs.integrate([nuA, nuB, nuC], T2, m=sym_mig_2) 
-   
-    # Split the E and West Pops 
-    fs = moments.Manips.split_3D_to_4D_3(fs, ns[2], ns[3])
+    # split S1 from the other populations, will result in [A,B], A will eventually become S1,
+    # then split S2 from population A, and split the E and West Pops;
+    # the two ancestral epochs are cached on (nuA, nuB, mAB, T1) and (nuC, mAC, mBC, T2)
+    fs = _ancestral_4D(ns, nuA, nuB, nuC, mAB, mAC, mBC, T1, T2)
 
  
-    asym_migbarrier = numpy.array([[0, m12, 0, 0],
-                             [m21, 0, 0, 0],
-                             [0, 0, 0, m34  ],
-                             [0, 0, m43, 0  ]])
+    asym_migbarrier = _mig_matrix(("split_asymmig_barrier_4D", 3), 4, _BARRIER_4, (m12, m21, m34, m43))
 
     # and now the final time epoch is integrated:
-    fs.integrate([nu1, nu2, nu3, nu4], T3, m=asym_migbarrier)
+    fs.integrate(_sizes(("split_asymmig_barrier_4D", 3), (nu1, nu2, nu3, nu4)), T3, m=asym_migbarrier)
     
     return fs
 
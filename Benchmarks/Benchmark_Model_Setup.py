@@ -0,0 +1,112 @@
+'''
+usage: python Benchmark_Model_Setup.py [number of calls]
+example: python Benchmark_Model_Setup.py 200000
+Micro-benchmark of the work a model function does around integrate: building
+the migration matrices and population size vectors of every epoch. It compares
+the nested-list numpy.array construction the models used before with the
+preallocated matrices and size vectors they fill in place now (_mig_matrix and
+_sizes in Models_3D.py and Models_4D.py), for the model with the most epochs
+and migration rates of each set: split_asym_mig_all and split_asym_mig_all_4D.
+The timings include the copies integrate makes of the arrays it is given.
+One full call of each model is timed as well, to put the overhead in context.
+-------------------------
+Written for Python 2.7 and 3.7
+Python modules required:
+  -Numpy
+  -moments
+-------------------------
+'''
+
+import sys
+import os
+import timeit
+
+#the model modules live in the folders next to this one
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "3D_Models"), os.path.join(here, "..", "4D_Models")]
+
+import numpy
+import Models_3D
+import Models_4D
+
+def setup_before_3D(params):
+    # matrices and sizes of split_asym_mig_all as they were built before
+    nu1, nuA, nu2, nu3, mA, m12, m13, m21, m23, m31, m32, T1, T2 = params
+    sym_mig_1 = numpy.array([[0, mA], [mA, 0]])
+    sizes_1 = [nu1, nuA]
+    sym_mig_2 = numpy.array([[0, m12, m13],
+                             [m21, 0, m23],
+                             [m31, m32, 0]])
+    sizes_2 = [nu1, nu2, nu3]
+    return sym_mig_1, sizes_1, sym_mig_2, sizes_2
+
+def setup_after_3D(params):
+    # matrices and sizes of split_asym_mig_all as they are filled now
+    nu1, nuA, nu2, nu3, mA, m12, m13, m21, m23, m31, m32, T1, T2 = params
+    sym_mig_1 = Models_3D._mig_matrix(("bench", 1), 2, Models_3D._PAIR_2, (mA, mA))
+    sizes_1 = Models_3D._sizes(("bench", 1), (nu1, nuA))
+    sym_mig_2 = Models_3D._mig_matrix(("bench", 2), 3, Models_3D._ALL_3, (m12, m13, m21, m23, m31, m32))
+    sizes_2 = Models_3D._sizes(("bench", 2), (nu1, nu2, nu3))
+    return sym_mig_1, sizes_1, sym_mig_2, sizes_2
+
+def setup_before_4D(params):
+    # matrices and sizes of split_asym_mig_all_4D as they were built before
+    (nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m13, m14, m21, m23, m24,
+         m31, m32, m34, m41, m42, m43, T1, T2, T3) = params
+    sym_mig_1 = numpy.array([[0, mAB], [mAB, 0]])
+    sizes_1 = [nuA, nuB]
+    sym_mig_2 = numpy.array([[0, mAB, mAC],
+                             [mAB, 0, mBC],
+                             [mAC, mBC, 0]])
+    sizes_2 = [nuA, nuB, nuC]
+    asym_mig = numpy.array([[0, m12, m13, m14],
+                             [m21, 0, m23, m24],
+                             [m31, m32, 0, m34],
+                             [m41, m42, m43, 0]])
+    sizes_3 = [nu1, nu2, nu3, nu4]
+    return sym_mig_1, sizes_1, sym_mig_2, sizes_2, asym_mig, sizes_3
+
+def setup_after_4D(params):
+    # matrices and sizes of split_asym_mig_all_4D as they are filled now
+    (nu1, nu2, nuA, nu3, nuB, nu4, nuC, mAB, mAC, mBC, m12, m13, m14, m21, m23, m24,
+         m31, m32, m34, m41, m42, m43, T1, T2, T3) = params
+    sym_mig_1 = Models_4D._mig_matrix(("bench", 1), 2, Models_4D._PAIR_2, (mAB, mAB))
+    sizes_1 = Models_4D._sizes(("bench", 1), (nuA, nuB))
+    sym_mig_2 = Models_4D._mig_matrix(("bench", 2), 3, Models_4D._ALL_3, (mAB, mAC, mAB, mBC, mAC, mBC))
+    sizes_2 = Models_4D._sizes(("bench", 2), (nuA, nuB, nuC))
+    asym_mig = Models_4D._mig_matrix(("bench", 3), 4, Models_4D._ALL_4,
+                                     (m12, m13, m14, m21, m23, m24, m31, m32, m34, m41, m42, m43))
+    sizes_3 = Models_4D._sizes(("bench", 3), (nu1, nu2, nu3, nu4))
+    return sym_mig_1, sizes_1, sym_mig_2, sizes_2, asym_mig, sizes_3
+
+def as_integrated(func):
+    # also make the copies integrate makes of the matrices and sizes it is given
+    return lambda params: [numpy.array(x) for x in func(params)]
+
+def per_call(func, params, number):
+    # best of three timings, in microseconds per call
+    return min(timeit.repeat(lambda: func(params), number=number, repeat=3)) / number * 1e6
+
+def main(number=200000):
+    rng = numpy.random.RandomState(1)
+    print("\nPer-call cost of building migration matrices and size vectors ({} calls):\n".format(number))
+    print("{0:<24}{1:>12}{2:>12}{3:>10}{4:>16}".format("model", "before (us)", "after (us)", "speedup", "full call (ms)"))
+    for name, module, before, after, nparams, ns in (
+            ("split_asym_mig_all", Models_3D, setup_before_3D, setup_after_3D, 13, [6, 6, 6]),
+            ("split_asym_mig_all_4D", Models_4D, setup_before_4D, setup_after_4D, 25, [4, 4, 4, 4])):
+        params = rng.uniform(0.1, 2, nparams)
+        #both ways give the same matrices and sizes
+        for a, b in zip(before(params), after(params)):
+            assert numpy.array_equal(numpy.asarray(a, dtype=float), b)
+        t_before = per_call(as_integrated(before), params, number)
+        t_after = per_call(as_integrated(after), params, number)
+        #every full call starts from empty model caches, as the same params are repeated
+        full_call = lambda: (module.clear_caches(), getattr(module, name)(params, ns))
+        t_full = min(timeit.repeat(full_call, number=3, repeat=3)) / 3 * 1e3
+        print("{0:<24}{1:>12.2f}{2:>12.2f}{3:>9.2f}x{4:>16.2f}".format(name, t_before, t_after,
+                                                                        t_before / t_after, t_full))
+    print("")
+
+#===========================================================================
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,189 @@
+'''
+usage: python Benchmark_Models.py [-o baseline.json] [--compare old_baseline.json]
+                                  [--ns 5 10 15 20 25 30] [--models name ...] [--repeat 3]
+                                  [--max-entries 300000] [--tolerance 0.25]
+example: python Benchmark_Models.py -o baseline.json
+         python Benchmark_Models.py -o new.json --compare baseline.json
+Times one evaluation of every model function in Models_3D.py and Models_4D.py
+for a range of sample sizes (the same number of samples in every population),
+at fixed representative parameters (sizes 1.0, migration rates 0.5, times 0.2).
+For every model and sample size it records:
+    time: the fastest of --repeat calls, in seconds
+    first_time: the first call
+    peak_bytes: the peak memory allocated during one more, untimed call (Python 3 only)
+    entries and nbytes: the number of entries and bytes of the spectrum
+The caches of the model modules (the cached start and ancestral epochs of the models)
+are emptied before every call, so every call is timed from a cold start.
+The results are saved as a JSON baseline file. With --compare, every model and
+sample size found in both files is checked, and those where time or peak memory
+grew by more than --tolerance (a fraction, 0.25 = 25%) are flagged as regressions;
+the script then exits with status 1. Sample sizes whose spectrum would have more
+than --max-entries entries are skipped, 4D spectra grow as (n+1)**4.
+-------------------------
+Written for Python 2.7 and 3.7
+Python modules required:
+  -Numpy
+  -moments
+-------------------------
+'''
+
+import sys
+import os
+import json
+import time
+import platform
+import argparse
+from datetime import datetime
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+#the model modules live in the folders next to this one
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, ".."), os.path.join(here, "..", "3D_Models"), os.path.join(here, "..", "4D_Models")]
+
+import numpy
+import moments
+import Models_3D
+import Models_4D
+import Model_Specs
+import Optimize_Functions
+
+def representative_params(names):
+    # fixed parameter values from the parameter names: sizes (nu) 1.0, migration rates (m) 0.5, times (T) 0.2
+    values = []
+    for name in names:
+        if name.startswith("nu"):
+            values.append(1.0)
+        elif name.startswith("m"):
+            values.append(0.5)
+        else:
+            values.append(0.2)
+    return numpy.array(values)
+
+def list_models(selected=None):
+    # return a list of (module name, model name, model function, parameter names, number of populations)
+    models = []
+    for module, specs, npops in ((Models_3D, Model_Specs.SPECS_3D, 3), (Models_4D, Model_Specs.SPECS_4D, 4)):
+        for name in sorted(specs):
+            if selected and name not in selected:
+                continue
+            models.append((module.__name__, name, getattr(module, name), specs[name][0], npops))
+    return models
+
+def clear_caches():
+    # empty the caches of the model modules, so a call does not reuse the work of the previous one
+    Models_3D.clear_caches()
+    Models_4D.clear_caches()
+
+def measure(func, params, ns, repeat):
+    #--------------------------------------------------------------------------------------
+    # time a model call, returns a dictionary with time, first_time, peak_bytes, entries, nbytes
+    #--------------------------------------------------------------------------------------
+    clear_caches()
+    start = time.time()
+    fs = func(params, ns)
+    first_time = time.time() - start
+
+    times = [first_time]
+    for i in range(repeat - 1):
+        clear_caches()
+        start = time.time()
+        func(params, ns)
+        times.append(time.time() - start)
+
+    #tracing slows the allocations down, so the peak memory comes from a separate untimed call
+    peak_bytes = None
+    if tracemalloc is not None:
+        clear_caches()
+        tracemalloc.start()
+        func(params, ns)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"time": min(times), "first_time": first_time, "peak_bytes": peak_bytes,
+                "entries": int(fs.size), "nbytes": int(fs.data.nbytes)}
+
+def run_benchmarks(ns_list, models=None, repeat=3, max_entries=300000):
+    #--------------------------------------------------------------------------------------
+    # benchmark the models for every sample size, returns the baseline dictionary
+
+    # Arguments
+    # ns_list: list of sample sizes per population, ex. [5, 10, 20]
+    # models: list of model names to run, all models if not provided
+    # repeat: number of calls per model and sample size, the fastest is kept
+    # max_entries: skip sample sizes whose spectrum has more entries than this
+    #--------------------------------------------------------------------------------------
+    results = []
+    for module_name, name, func, param_names, npops in list_models(models):
+        params = representative_params(param_names)
+        for n in ns_list:
+            ns = [n] * npops
+            if (n + 1)**npops > max_entries:
+                print("\t{0:<32} ns={1:<4} skipped ({2} entries)".format(name, n, (n + 1)**npops))
+                continue
+            result = measure(func, params, ns, repeat)
+            result.update({"module": module_name, "model": name, "ns": ns, "param_number": len(params)})
+            results.append(result)
+            print("\t{0:<32} ns={1:<4} {2:>10.3f} s {3:>12} bytes peak {4:>9} entries".format(
+                name, n, result["time"], result["peak_bytes"], result["entries"]))
+
+    return {"meta": {"date": datetime.now().isoformat(), "python": platform.python_version(),
+                     "numpy": numpy.__version__, "moments": getattr(moments, "__version__", None),
+                     "machine": platform.machine(), "repeat": repeat, "ns": list(ns_list)},
+            "results": results}
+
+def compare_baselines(new, old, tolerance=0.25):
+    #--------------------------------------------------------------------------------------
+    # return a list of regressions = (model, ns, measure, old value, new value) for every
+    # model and sample size in both baselines whose time or peak memory grew by more than tolerance
+    #--------------------------------------------------------------------------------------
+    previous = dict(((r["model"], tuple(r["ns"])), r) for r in old["results"])
+    regressions = []
+    for r in new["results"]:
+        before = previous.get((r["model"], tuple(r["ns"])))
+        if before is None:
+            continue
+        for key in ("time", "peak_bytes"):
+            if r[key] is not None and before[key] and r[key] > before[key] * (1 + tolerance):
+                regressions.append((r["model"], r["ns"], key, before[key], r[key]))
+    return regressions
+
+def write_baseline(fname, baseline):
+    # replace the baseline file in one step
+    Optimize_Functions.atomic_write(fname, lambda fh: json.dump(baseline, fh, indent=1), mode='w')
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Models_3D and Models_4D model functions.")
+    parser.add_argument("-o", "--output", default="model_benchmarks.json", help="baseline file to write")
+    parser.add_argument("--compare", help="previous baseline file to check for regressions")
+    parser.add_argument("--ns", type=int, nargs="+", default=[5, 10, 15, 20, 25, 30],
+                            help="sample sizes per population")
+    parser.add_argument("--models", nargs="+", help="only run these models")
+    parser.add_argument("--repeat", type=int, default=3, help="calls per model and sample size")
+    parser.add_argument("--max-entries", type=int, default=300000,
+                            help="skip sample sizes with larger spectra")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="fraction by which time or memory may grow before it is a regression")
+    args = parser.parse_args()
+
+    print("\nBenchmarking models for ns = {}\n".format(args.ns))
+    baseline = run_benchmarks(args.ns, args.models, args.repeat, args.max_entries)
+    write_baseline(args.output, baseline)
+    print("\nBaseline written to {}\n".format(args.output))
+
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            old = json.load(fh)
+        regressions = compare_baselines(baseline, old, args.tolerance)
+        for model, ns, key, before, after in regressions:
+            print("\tREGRESSION {0:<32} ns={1} {2}: {3:.4g} -> {4:.4g}".format(model, ns, key, before, after))
+        if regressions:
+            print("\n{0} regressions compared with {1}\n".format(len(regressions), args.compare))
+            sys.exit(1)
+        print("No regressions compared with {}\n".format(args.compare))
+
+#===========================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+'''
+usage: python Benchmark_Optimize.py [--model split_nomig] [--params 1.0 0.5 ...] [--ns 8 8 8]
+                                    [--theta 1000] [--schedules schedules.json] [--seed 1]
+                                    [--unfolded] [-o results.json] [--keep DIR] [--verbose]
+example: python Benchmark_Optimize.py --model split_nomig --ns 8 8 8
+Runs the whole optimization routine on a spectrum simulated from a model in
+Models_3D.py with known parameters, to see what a settings schedule costs and
+how well it recovers the truth before running it on real data. The spectrum is
+the model spectrum for --params scaled by --theta, with Poisson noise (--seed).
+Optimize_Routine is then run once per settings schedule (rounds, reps, maxiters
+and folds) and for every schedule it reports:
+    time: wall time of the whole routine
+    time_to_best: time until the routine first evaluated its best log-likelihood
+    evals and evals_to_best: the number of model evaluations, in total and until then
+    best_ll: the best log-likelihood found, next to true_ll for the true parameters
+    mean_log10_error and max_rel_error: how far the best parameters are from the truth
+The default schedules go from a quick run to the settings in the README, other
+schedules can be given as a JSON file with a list of
+    {"name": "...", "rounds": 2, "reps": [10, 10], "maxiters": [3, 5], "folds": [2, 1]}
+with an optional "elite" size to start later rounds from an elite pool, and optional
+"projections" for coarse-to-fine rounds, ex. [[4, 4, 4], null] (see Optimize_Routine).
+Every schedule starts with empty model caches. Everything runs serially on the CPU;
+the routine's output files are written to a temporary folder that is removed
+afterwards, unless --keep is given.
+-------------------------
+Written for Python 2.7 and 3.7
+Python modules required:
+  -Numpy
+  -Scipy
+  -moments
+-------------------------
+'''
+
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+#Optimize_Functions and the model modules live in the folders next to this one
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, ".."), os.path.join(here, "..", "3D_Models")]
+
+import numpy
+import moments
+import Models_3D
+import Model_Specs
+import Optimize_Functions
+
+DEFAULT_SCHEDULES = [
+    {"name": "quick", "rounds": 2, "reps": [4, 4], "maxiters": [3, 5], "folds": [2, 1]},
+    {"name": "medium", "rounds": 3, "reps": [8, 8, 8], "maxiters": [3, 5, 10], "folds": [3, 2, 1]},
+    {"name": "medium_coarse", "rounds": 3, "reps": [8, 8, 8], "maxiters": [3, 5, 10], "folds": [3, 2, 1],
+     "projections": [[4, 4, 4], [6, 6, 6], None]},
+    {"name": "medium_elite", "rounds": 3, "reps": [8, 8, 8], "maxiters": [3, 5, 10], "folds": [3, 2, 1], "elite": 4},
+    {"name": "readme", "rounds": 4, "reps": [10, 20, 30, 40], "maxiters": [3, 5, 10, 15], "folds": [3, 2, 2, 1]},
+]
+
+class EvaluationTracker(object):
+    #--------------------------------------------------------------------------------------
+    # wrap a model function to count its evaluations and remember when the best
+    # log-likelihood was first reached, and with which parameters
+
+    # Arguments
+    # func: the model function
+    # fs: the spectrum being fit
+    #--------------------------------------------------------------------------------------
+    def __init__(self, func, fs):
+        self.func = func
+        self.fs = fs
+        self.start = time.time()
+        self.evals = 0
+        self.best = (-numpy.inf, None, None, None)
+
+    def __call__(self, params, ns):
+        sim_model = self.func(params, ns)
+        self.evals += 1
+        #calls at projected sample sizes (coarse rounds) are counted but not scored
+        if list(ns) != list(self.fs.sample_sizes):
+            return sim_model
+        ll = moments.Inference.ll_multinom(sim_model, self.fs)
+        if ll > self.best[0]:
+            #(ll, time since start, evaluations so far, parameters)
+            self.best = (ll, time.time() - self.start, self.evals, numpy.array(params, dtype=float))
+        return sim_model
+
+def simulate_spectrum(func, params, ns, theta=1000., seed=1, folded=True):
+    # return a spectrum with Poisson noise around the model spectrum for params scaled by theta
+    rng = numpy.random.RandomState(seed)
+    model = func(params, ns) * theta
+    fs = moments.Spectrum(rng.poisson(numpy.maximum(model.data, 0)).astype(float), mask=model.mask)
+    return fs.fold() if folded else fs
+
+def run_schedule_benchmark(fs, func, true_params, schedule, outdir, fs_folded=True, seed=1, verbose=False):
+    #--------------------------------------------------------------------------------------
+    # run Optimize_Routine with one settings schedule, returns a dictionary of measurements
+    #--------------------------------------------------------------------------------------
+    #every schedule starts with empty model caches (cached start and ancestral epochs)
+    Models_3D.clear_caches()
+    tracker = EvaluationTracker(func, fs)
+    #the starting parameters are perturbed with the global numpy random generator
+    numpy.random.seed(seed)
+    stdout = sys.stdout
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        Optimize_Functions.Optimize_Routine(fs, os.path.join(outdir, schedule["name"]), func.__name__, tracker,
+                                                schedule["rounds"], len(true_params), fs_folded=fs_folded,
+                                                reps=schedule["reps"], maxiters=schedule["maxiters"],
+                                                folds=schedule["folds"], elite=schedule.get("elite"),
+                                                projections=schedule.get("projections"))
+    finally:
+        if not verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+    elapsed = time.time() - tracker.start
+
+    best_ll, time_to_best, evals_to_best, best_params = tracker.best
+    ratio = best_params / numpy.asarray(true_params, dtype=float)
+    return {"name": schedule["name"], "rounds": schedule["rounds"], "reps": schedule["reps"],
+            "maxiters": schedule["maxiters"], "folds": schedule["folds"], "elite": schedule.get("elite"),
+            "projections": schedule.get("projections"),
+            "time": elapsed, "time_to_best": time_to_best, "evals": tracker.evals,
+            "evals_to_best": evals_to_best, "best_ll": float(best_ll),
+            "best_params": [float(x) for x in best_params],
+            "mean_log10_error": float(numpy.mean(numpy.abs(numpy.log10(ratio)))),
+            "max_rel_error": float(numpy.max(numpy.abs(ratio - 1)))}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Optimize_Routine on a simulated spectrum.")
+    parser.add_argument("--model", default="split_nomig", help="model from Models_3D.py")
+    parser.add_argument("--params", type=float, nargs="+", help="true parameters, defaults depend on the model")
+    parser.add_argument("--ns", type=int, nargs=3, default=[8, 8, 8], help="sample sizes")
+    parser.add_argument("--theta", type=float, default=1000., help="scaling of the simulated spectrum")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the noise and the perturbations")
+    parser.add_argument("--unfolded", action="store_true", help="fit the unfolded spectrum")
+    parser.add_argument("--schedules", help="JSON file with a list of settings schedules")
+    parser.add_argument("-o", "--output", help="JSON file to write the results to")
+    parser.add_argument("--keep", help="keep the routine's output files in this folder")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the routine")
+    args = parser.parse_args()
+
+    func = getattr(Models_3D, args.model)
+    names = Model_Specs.SPECS_3D[args.model][0]
+    if args.params is None:
+        #sizes 1.0 and 2.0 in turn, migration rates 0.5, times 0.2
+        true_params = [(1.0, 2.0)[i % 2] if n.startswith("nu") else 0.5 if n.startswith("m") else 0.2
+                           for i, n in enumerate(names)]
+    elif len(args.params) != len(names):
+        raise ValueError("{0} has {1} parameters: {2}".format(args.model, len(names), ", ".join(names)))
+    else:
+        true_params = args.params
+    schedules = DEFAULT_SCHEDULES
+    if args.schedules:
+        with open(args.schedules, 'r') as fh:
+            schedules = json.load(fh)
+
+    fs_folded = not args.unfolded
+    fs = simulate_spectrum(func, true_params, args.ns, args.theta, args.seed, fs_folded)
+    true_ll = float(moments.Inference.ll_multinom(func(true_params, args.ns), fs))
+    print("\nSimulated {0} with ns = {1}, {2} = {3}".format(args.model, args.ns, ", ".join(names), true_params))
+    print("Log-likelihood of the true parameters: {0:.2f}\n".format(true_ll))
+
+    outdir = args.keep if args.keep else tempfile.mkdtemp(prefix="benchmark_optimize_")
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    results = []
+    try:
+        print("{0:<14}{1:>10}{2:>14}{3:>8}{4:>15}{5:>12}{6:>16}{7:>15}".format(
+            "schedule", "time (s)", "to best (s)", "evals", "evals to best", "best ll",
+            "mean log10 err", "max rel err"))
+        for schedule in schedules:
+            result = run_schedule_benchmark(fs, func, true_params, schedule, outdir, fs_folded,
+                                                args.seed, args.verbose)
+            result["true_ll"] = true_ll
+            results.append(result)
+            print("{name:<14}{time:>10.1f}{time_to_best:>14.1f}{evals:>8}{evals_to_best:>15}{best_ll:>12.2f}"
+                      "{mean_log10_error:>16.3f}{max_rel_error:>15.3f}".format(**result))
+    finally:
+        if not args.keep:
+            shutil.rmtree(outdir)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({"model": args.model, "ns": args.ns, "theta": args.theta, "seed": args.seed,
+                       "true_params": list(true_params), "true_ll": true_ll, "results": results}, fh, indent=1)
+    print("")
+
+#===========================================================================
+if __name__ == "__main__":
+    main()
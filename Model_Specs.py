@@ -0,0 +1,314 @@
+'''
+Declarative specifications of demographic models, compiled to model functions.
+Every model in Models_3D.py and Models_4D.py follows the same skeleton: a steady
+state for all samples, then a series of splits (each one splits the last population
+in two) and epochs of integration with population sizes, a time and a migration
+matrix. Here a model is written as its parameter names plus that list of events:
+
+    import Model_Specs as MS
+    split_nomig = MS.compile_model("split_nomig",
+        ["nu1", "nuA", "nu2", "nu3", "mA", "T1", "T2"],
+        [MS.split(),
+         MS.epoch(["nu1", "nuA"], "T1", MS.sym_mig([((0, 1), "mA")])),
+         MS.split(),
+         MS.epoch(["nu1", "nu2", "nu3"], "T2")])
+
+The compiled model is called like the hand-written ones, split_nomig(params, ns),
+and can be given to Optimize_Routine. Its migration matrices are allocated once and
+refilled in place on every call, and the start of the model that does not depend on
+the parameters (the steady state and the first splits) is computed once per set of
+sample sizes and shared by all models that start the same way.
+SPECS_3D and SPECS_4D re-express the models of Models_3D.py and Models_4D.py,
+compile_specs(SPECS_3D) returns a dictionary of compiled models by name.
+-------------------------
+Written for Python 2.7 and 3.7
+Python modules required:
+  -Numpy
+  -moments
+-------------------------
+'''
+
+import numpy
+import moments
+
+#the moments.Manips functions that split the last population, by number of populations before the split
+#(looked up by name on every call, so the timing wrappers of Optimize_Functions.PhaseTimer are seen)
+_SPLITS = {1: "split_1D_to_2D",
+           2: "split_2D_to_3D_2",
+           3: "split_3D_to_4D_3"}
+
+#spectra after the parameter-independent start of a model, keyed on (events, sample sizes)
+_prefix_cache = {}
+
+def split():
+    #--------------------------------------------------------------------------------------
+    # event that splits the last population in two, the first keeps the next sample size
+    # and the second all remaining samples, ex. the second split of a 3D model is
+    # moments.Manips.split_2D_to_3D_2(fs, ns[1], ns[2])
+    #--------------------------------------------------------------------------------------
+    return ("split",)
+
+def epoch(sizes, T, mig=None, dt_fac=None):
+    #--------------------------------------------------------------------------------------
+    # event that integrates the spectrum, sizes and T are parameter names or numbers
+
+    # Arguments
+    # sizes: list with the size of every current population
+    # T: time of the epoch
+    # mig: migration entries made with sym_mig and asym_mig (they can be added up), if
+    #      not provided there is no migration
+    # dt_fac: timestep factor given to integrate, if not provided the moments default is used
+    #--------------------------------------------------------------------------------------
+    return ("epoch", tuple(sizes), T, tuple(mig) if mig else (), dt_fac)
+
+def sym_mig(pairs):
+    #--------------------------------------------------------------------------------------
+    # symmetric migration, returns migration entries with m[i,j] = m[j,i] = value
+
+    # Arguments
+    # pairs: list of ((i, j), value), value is a parameter name or a number,
+    #        ex. zip(adjacent_pairs(3), ["m12", "m23"])
+    #--------------------------------------------------------------------------------------
+    entries = []
+    for (i, j), value in pairs:
+        entries.extend([(i, j, value), (j, i, value)])
+    return tuple(entries)
+
+def asym_mig(pairs):
+    #--------------------------------------------------------------------------------------
+    # asymmetric migration, returns migration entries with m[i,j] = value (the rate from
+    # population j to population i)
+
+    # Arguments
+    # pairs: list of ((i, j), value), value is a parameter name or a number
+    #--------------------------------------------------------------------------------------
+    return tuple((i, j, value) for (i, j), value in pairs)
+
+def adjacent_pairs(npops):
+    # pairs of populations next to each other, ex. [(0, 1), (1, 2)] for 3 populations
+    return [(i, i + 1) for i in range(npops - 1)]
+
+def all_pairs(npops):
+    # all pairs of populations, ex. [(0, 1), (0, 2), (1, 2)] for 3 populations
+    return [(i, j) for i in range(npops) for j in range(i + 1, npops)]
+
+def barrier_pairs(groups):
+    # pairs of populations within the same group, no migration across the barrier,
+    # ex. [(0, 1), (2, 3)] for groups [[0, 1], [2, 3]]
+    return [(group[i], group[j]) for group in groups for i, j in all_pairs(len(group))]
+
+def both_ways(pairs):
+    # every pair in both directions, for asymmetric migration, ex. [(0, 1), (1, 0)] for [(0, 1)]
+    return [p for i, j in pairs for p in [(i, j), (j, i)]]
+
+class CompiledModel(object):
+    #--------------------------------------------------------------------------------------
+    # model function made from a list of events, called as model(params, ns)
+
+    # Arguments
+    # name: name of the model
+    # params: list of parameter names, in the order of the params vector
+    # events: list of split() and epoch() events
+    #--------------------------------------------------------------------------------------
+    def __init__(self, name, params, events):
+        self.__name__ = name
+        self.params = list(params)
+        self.param_number = len(self.params)
+        self.events = tuple(events)
+        index = dict((p, i) for i, p in enumerate(self.params))
+
+        def lookup(value):
+            #parameter names become (index, None), numbers become (None, value)
+            if isinstance(value, str):
+                if value not in index:
+                    raise ValueError("Model {0} uses unknown parameter {1}.".format(name, value))
+                return index[value], None
+            return None, float(value)
+
+        def uses_params(event):
+            return event[0] == "epoch" and any(isinstance(v, str) for v in
+                                                  event[1] + (event[2],) + tuple(e[2] for e in event[3]))
+
+        #the leading events that use no parameters are shared across calls
+        nprefix = 0
+        while nprefix < len(self.events) and not uses_params(self.events[nprefix]):
+            nprefix += 1
+        self.prefix = self.events[:nprefix]
+
+        npops = 1
+        self.steps = []
+        for n, event in enumerate(self.events):
+            if event[0] == "split":
+                if npops not in _SPLITS:
+                    raise ValueError("Model {0} splits more than 4 populations.".format(name))
+                step = ("split", npops)
+                npops += 1
+            elif event[0] == "epoch":
+                sizes, T, mig, dt_fac = event[1:]
+                if len(sizes) != npops:
+                    raise ValueError("Model {0} gives {1} sizes for {2} populations.".format(name, len(sizes), npops))
+                #the migration matrix of the epoch, constants are filled in now and parameters on every call
+                matrix = numpy.zeros((npops, npops))
+                entries = []
+                for i, j, value in mig:
+                    k, const = lookup(value)
+                    if k is None:
+                        matrix[i, j] = const
+                    else:
+                        entries.append((i, j, k))
+                kwargs = {} if dt_fac is None else {"dt_fac": dt_fac}
+                step = ("epoch", [lookup(v) for v in sizes], lookup(T), matrix, entries, kwargs)
+            else:
+                raise ValueError("Model {0} has an unknown event {1}.".format(name, event[0]))
+            if n >= nprefix:
+                self.steps.append(step)
+        self.npops = npops
+
+    def start(self, ns):
+        # spectrum after the parameter-independent start of the model, computed once per
+        # prefix and sample sizes, every call gets a fresh copy that is safe to integrate in place
+        key = (self.prefix, tuple(int(n) for n in ns))
+        if key not in _prefix_cache:
+            fs = moments.Spectrum(moments.LinearSystem_1D.steady_state_1D(sum(ns)))
+            npops = 1
+            for event in self.prefix:
+                if event[0] == "split":
+                    fs = getattr(moments.Manips, _SPLITS[npops])(fs, ns[npops - 1], sum(ns[npops:]))
+                    npops += 1
+                else:
+                    kwargs = {} if event[4] is None else {"dt_fac": event[4]}
+                    matrix = numpy.zeros((npops, npops))
+                    for i, j, value in event[3]:
+                        matrix[i, j] = value
+                    fs.integrate(list(event[1]), event[2], m=matrix, **kwargs)
+            _prefix_cache[key] = fs
+        return _prefix_cache[key].copy()
+
+    def __call__(self, params, ns):
+        if len(ns) != self.npops:
+            raise ValueError("Model {0} needs {1} sample sizes, got {2}.".format(self.__name__, self.npops, len(ns)))
+        fs = self.start(ns)
+        for step in self.steps:
+            if step[0] == "split":
+                npops = step[1]
+                fs = getattr(moments.Manips, _SPLITS[npops])(fs, ns[npops - 1], sum(ns[npops:]))
+            else:
+                sizes, T, matrix, entries, kwargs = step[1:]
+                #rewrite the parameter entries of the preallocated migration matrix
+                for i, j, k in entries:
+                    matrix[i, j] = params[k]
+                nu = [params[k] if k is not None else const for k, const in sizes]
+                fs.integrate(nu, params[T[0]] if T[0] is not None else T[1], m=matrix, **kwargs)
+        return fs
+
+def compile_model(name, params, events):
+    # return the model function for a list of parameter names and events, see CompiledModel
+    return CompiledModel(name, params, events)
+
+def compile_specs(specs):
+    # return a dictionary of compiled models from a dictionary of {name: (params, events)}
+    return dict((name, compile_model(name, params, events)) for name, (params, events) in specs.items())
+
+
+#The models of Models_3D.py
+SPECS_3D = {
+    #Simultaneous Split Models
+    "sim_split_no_mig": (["nu1", "nu2", "nu3", "T1"],
+        [split(), split(),
+         epoch(["nu1", "nu2", "nu3"], "T1", dt_fac=0.01)]),
+    "sim_split_sym_mig_adjacent": (["nu1", "nu2", "nu3", "m12", "m23", "T1"],
+        [split(), split(),
+         epoch(["nu1", "nu2", "nu3"], "T1", sym_mig(zip(adjacent_pairs(3), ["m12", "m23"])), dt_fac=0.01)]),
+    "sim_split_asym_mig_adjacent": (["nu1", "nu2", "nu3", "m12", "m21", "m23", "m32", "T1"],
+        [split(), split(),
+         epoch(["nu1", "nu2", "nu3"], "T1",
+                   asym_mig(zip(both_ways(adjacent_pairs(3)), ["m12", "m21", "m23", "m32"])), dt_fac=0.01)]),
+    "sim_split_sym_mig_all": (["nu1", "nu2", "nu3", "m12", "m13", "m23", "T1"],
+        [split(), split(),
+         epoch(["nu1", "nu2", "nu3"], "T1", sym_mig(zip(all_pairs(3), ["m12", "m13", "m23"])), dt_fac=0.01)]),
+    "sim_split_asym_mig_all": (["nu1", "nu2", "nu3", "m12", "m21", "m13", "m31", "m23", "m32", "T1"],
+        [split(), split(),
+         epoch(["nu1", "nu2", "nu3"], "T1",
+                   asym_mig(zip(both_ways(all_pairs(3)), ["m12", "m21", "m13", "m31", "m23", "m32"])), dt_fac=0.01)]),
+    #Split models
+    "split_nomig": (["nu1", "nuA", "nu2", "nu3", "mA", "T1", "T2"],
+        [split(),
+         epoch(["nu1", "nuA"], "T1", sym_mig([((0, 1), "mA")])),
+         split(),
+         epoch(["nu1", "nu2", "nu3"], "T2")]),
+    "split_sym_mig_all": (["nu1", "nuA", "nu2", "nu3", "mA", "m12", "m23", "m13", "T1", "T2"],
+        [split(),
+         epoch(["nu1", "nuA"], "T1", sym_mig([((0, 1), "mA")])),
+         split(),
+         epoch(["nu1", "nu2", "nu3"], "T2", sym_mig(zip(all_pairs(3), ["m12", "m13", "m23"])))]),
+    "split_asym_mig_all": (["nu1", "nuA", "nu2", "nu3", "mA", "m12", "m13", "m21", "m23", "m31", "m32", "T1", "T2"],
+        [split(),
+         epoch(["nu1", "nuA"], "T1", sym_mig([((0, 1), "mA")]), dt_fac=0.01),
+         split(),
+         epoch(["nu1", "nu2", "nu3"], "T2",
+                   asym_mig(zip(both_ways(all_pairs(3)), ["m12", "m21", "m13", "m31", "m23", "m32"])), dt_fac=0.01)]),
+    "split_symmig_adjacent": (["nu1", "nuA", "nu2", "nu3", "mA", "m23", "T1", "T2"],
+        [split(),
+         epoch(["nu1", "nuA"], "T1", sym_mig([((0, 1), "mA")]), dt_fac=0.01),
+         split(),
+         epoch(["nu1", "nu2", "nu3"], "T2", sym_mig([((1, 2), "m23")]), dt_fac=0.01)]),
+    "split_asymmig_adjacent": (["nu1", "nuA", "nu2", "nu3", "mAB", "m23", "m32", "T1", "T2"],
+        [split(),
+         epoch(["nu1", "nuA"], "T1", sym_mig([((0, 1), "mAB")]), dt_fac=0.01),
+         split(),
+         epoch(["nu1", "nu2", "nu3"], "T2", asym_mig(zip(both_ways([(1, 2)]), ["m23", "m32"])), dt_fac=0.01)]),
+}
+
+#the two ancestral epochs shared by the split models of Models_4D.py
+_ANCESTRAL_4D = [split(),
+                 epoch(["nuA", "nuB"], "T1", sym_mig([((0, 1), "mAB")])),
+                 split(),
+                 epoch(["nuA", "nuB", "nuC"], "T2", sym_mig(zip(all_pairs(3), ["mAB", "mAC", "mBC"]))),
+                 split()]
+_ANCESTRAL_4D_PARAMS = ["nu1", "nu2", "nuA", "nu3", "nuB", "nu4", "nuC", "mAB", "mAC", "mBC"]
+
+#The models of Models_4D.py
+SPECS_4D = {
+    #Simultaneous Split Models
+    "sim_split_nomig_4D": (["nu1", "nu2", "nu3", "nu4", "T1"],
+        [split(), split(), split(),
+         epoch(["nu1", "nu2", "nu3", "nu4"], "T1")]),
+    "sim_split_all_sym_mig_4D": (["nu1", "nu2", "nu3", "nu4", "m12", "m13", "m14", "m23", "m24", "m34", "T1"],
+        [split(), split(), split(),
+         epoch(["nu1", "nu2", "nu3", "nu4"], "T1",
+                   sym_mig(zip(all_pairs(4), ["m12", "m13", "m14", "m23", "m24", "m34"])))]),
+    "sim_split_all_asym_mig_4D": (["nu1", "nu2", "nu3", "nu4", "m12", "m13", "m14", "m21", "m23", "m24",
+                                   "m31", "m32", "m34", "m41", "m42", "m43", "T1"],
+        [split(), split(), split(),
+         epoch(["nu1", "nu2", "nu3", "nu4"], "T1",
+                   asym_mig(zip([(i, j) for i in range(4) for j in range(4) if i != j],
+                                ["m12", "m13", "m14", "m21", "m23", "m24", "m31", "m32", "m34", "m41", "m42", "m43"])))]),
+    #as in Models_4D.py, the rates between pops 3 and 4 sit on the diagonal of the matrix
+    "sim_split_sym_mig_barrier_4D": (["nu1", "nu2", "nu3", "nu4", "m12", "m34", "T1"],
+        [split(), split(), split(),
+         epoch(["nu1", "nu2", "nu3", "nu4"], "T1",
+                   sym_mig([((0, 1), "m12")]) + asym_mig([((2, 2), "m34"), ((3, 3), "m34")]))]),
+    "sim_split_asym_mig_barrier_4D": (["nu1", "nu2", "nu3", "nu4", "m12", "m21", "m34", "m43", "T1"],
+        [split(), split(), split(),
+         epoch(["nu1", "nu2", "nu3", "nu4"], "T1",
+                   asym_mig([((0, 1), "m12"), ((1, 0), "m21"), ((2, 2), "m34"), ((3, 3), "m43")]))]),
+    #Split Models
+    "split_sym_mig_4D": (_ANCESTRAL_4D_PARAMS + ["m12", "m13", "m14", "m23", "m24", "m34", "T1", "T2", "T3"],
+        _ANCESTRAL_4D + [epoch(["nu1", "nu2", "nu3", "nu4"], "T3",
+                                   sym_mig(zip(all_pairs(4), ["m12", "m13", "m14", "m23", "m24", "m34"])))]),
+    "split_asym_mig_all_4D": (_ANCESTRAL_4D_PARAMS + ["m12", "m13", "m14", "m21", "m23", "m24", "m31", "m32",
+                                                      "m34", "m41", "m42", "m43", "T1", "T2", "T3"],
+        _ANCESTRAL_4D + [epoch(["nu1", "nu2", "nu3", "nu4"], "T3",
+                                   asym_mig(zip([(i, j) for i in range(4) for j in range(4) if i != j],
+                                                ["m12", "m13", "m14", "m21", "m23", "m24",
+                                                 "m31", "m32", "m34", "m41", "m42", "m43"])))]),
+    "split_nomig_4D": (_ANCESTRAL_4D_PARAMS + ["T1", "T2", "T3"],
+        _ANCESTRAL_4D + [epoch(["nu1", "nu2", "nu3", "nu4"], "T3")]),
+    "split_symmig_barrier_4D": (_ANCESTRAL_4D_PARAMS + ["m12", "m34", "T1", "T2", "T3"],
+        _ANCESTRAL_4D + [epoch(["nu1", "nu2", "nu3", "nu4"], "T3",
+                                   sym_mig(zip(barrier_pairs([[0, 1], [2, 3]]), ["m12", "m34"])))]),
+    "split_asymmig_barrier_4D": (_ANCESTRAL_4D_PARAMS + ["m12", "m21", "m34", "m43", "T1", "T2", "T3"],
+        _ANCESTRAL_4D + [epoch(["nu1", "nu2", "nu3", "nu4"], "T3",
+                                   asym_mig(zip(both_ways(barrier_pairs([[0, 1], [2, 3]])),
+                                                ["m12", "m21", "m34", "m43"])))]),
+}
@@ -14,7 +14,35 @@ Updated August 2019
 
 import sys
 import os
+import multiprocessing
+import pickle
+import uuid
+import importlib
+import heapq
+import time
+import tempfile
+import sqlite3
+import json
+import timeit
+import socket
+import atexit
+from collections import OrderedDict
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+try:
+    from multiprocessing.connection import wait as wait_connections
+except ImportError:
+    #Python 2.7, KillablePool.poll then checks its pipes in a loop
+    wait_connections = None
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 import numpy
+from scipy.special import gammaln
 import moments
 from datetime import datetime
 
@@ -108,6 +136,37 @@ def parse_opt_settings(rounds, reps=None, maxiters=None, folds=None):
         
     return reps_list, maxiters_list, folds_list
 
+def parse_projections(rounds, projections=None, sample_sizes=None):
+    #--------------------------------------------------------------------------------------
+    # function to correctly deal with the projection sizes of every round, returns a list with
+    # the sample sizes to project the spectrum to for each round, or None for the full spectrum
+    
+    # Arguments
+    # rounds: number of optimization rounds to perform
+    # projections: a list with, for each round, a list of sample sizes (one per population)
+    #              or None for the full spectrum
+    # sample_sizes: the sample sizes of the full spectrum
+    #--------------------------------------------------------------------------------------
+    rounds = int(rounds)
+    
+    #every round at full resolution unless asked otherwise
+    if projections is None:
+        return [None] * rounds
+    elif len(projections) != rounds:
+        raise ValueError("List length of projection values does match the number of rounds: {}".format(rounds))
+    
+    projections_list = []
+    full = [int(n) for n in sample_sizes]
+    for ns in projections:
+        if ns is not None:
+            ns = [int(n) for n in ns]
+            if len(ns) != len(full) or min(ns) < 1 or any(n > m for n, m in zip(ns, full)):
+                raise ValueError("Projection sizes must be one sample size per population, between 1 and {0}: {1}".format(full, ns))
+            if ns == full:
+                ns = None
+        projections_list.append(ns)
+    return projections_list
+
 def collect_results(fs, sim_model, params_opt, roundrep, fs_folded):
     #--------------------------------------------------------------------------------------
     # gather up a bunch of results, return a list =
@@ -155,34 +214,1730 @@ def collect_results(fs, sim_model, params_opt, roundrep, fs_folded):
     #send list of results back
     return temp_results
 
-def write_log(outfile, model_name, rep_results, roundrep):
+def fold_stack(data, mask, out=None):
+    #--------------------------------------------------------------------------------------
+    # fold a stack of spectra along every axis but the first, the same way as
+    # moments.Spectrum.fold, returns (folded data, folded mask)
+    
+    # Arguments
+    # data: array of spectra, shape (number of spectra,) + spectrum shape
+    # mask: boolean array of the same shape, True where entries are masked
+    # out: boolean array of the spectrum shape, True for the entries that are folded out
+    #      (computed from the spectrum shape if not provided)
+    #--------------------------------------------------------------------------------------
+    shape = data.shape[1:]
+    total_samples = numpy.sum(numpy.array(shape) - 1)
+    total_per_entry = numpy.sum(numpy.indices(shape), axis=0)
+    if out is None:
+        out = total_per_entry > int(total_samples / 2)
+    ambiguous = total_per_entry == total_samples / 2.0
+    #reverse every spectrum along all of its axes
+    rev = (slice(None),) + (slice(None, None, -1),) * len(shape)
+    
+    folded = data + numpy.where(out, data, 0)[rev]
+    folded[:, out] = 0
+    amb = numpy.where(ambiguous, data, 0)
+    folded += -0.5 * amb + 0.5 * amb[rev]
+    
+    return folded, mask | mask[rev] | out
+
+def score_spectra(fs, models, param_number, fs_folded=True, decimals=2):
+    #--------------------------------------------------------------------------------------
+    # score a batch of model spectra against the same empirical spectrum in one pass,
+    # returns four arrays with one value per model = (log-likelihood, AIC, chi^2, theta)
+    # these match what collect_results gives (moments.Inference.ll_multinom and
+    # optimal_sfs_scaling, chi^2 with the scaled model), but folding, scaling and masking
+    # are done for the whole stack at once, with the data terms computed only once
+    
+    # Arguments
+    # fs: spectrum object name
+    # models: a list of model spectra (moments Spectrum objects or arrays) with the shape
+    #         of fs, or an array of shape (number of models,) + fs.shape
+    # param_number: number of parameters of the model, for AIC
+    # fs_folded: a Boolean (True, False) for whether empirical spectrum is folded or not
+    # decimals: round log-likelihood, theta and chi^2 as collect_results does (theta is
+    #           rounded before chi^2 is computed); None returns the unrounded values
     #--------------------------------------------------------------------------------------
-    #reproduce replicate log to bigger log file, because constantly re-written
+    data = numpy.array([numpy.ma.getdata(m) for m in models], dtype=float)
+    mask = numpy.array([numpy.ma.getmaskarray(m) for m in models])
+    if data.shape[1:] != fs.shape:
+        raise ValueError("Model spectra have shape {0}, expected {1}.".format(data.shape[1:], fs.shape))
+    fs_data = numpy.ma.getdata(fs)
+    fs_mask = numpy.ma.getmaskarray(fs)
+    
+    #the fold of the (unscaled) models is used for theta when fs is folded
+    if fs.folded:
+        out = numpy.sum(numpy.indices(fs.shape), axis=0) > int(numpy.sum(numpy.array(fs.shape) - 1) / 2)
+        fold_data, fold_mask = fold_stack(data, mask, out)
+    else:
+        fold_data, fold_mask = data, mask
+    
+    #optimal theta, summed over the entries that are masked in neither model nor data
+    joint = fold_mask | fs_mask
+    theta = numpy.where(joint, 0, fs_data).sum(axis=tuple(range(1, data.ndim)))
+    theta = theta / numpy.where(joint, 0, fold_data).sum(axis=tuple(range(1, data.ndim)))
+    
+    #Poisson log-likelihood of the data with the scaled models, the data term is shared
+    shape = (-1,) + (1,) * fs.ndim
+    if fs.folded:
+        ll_data, ll_mask = fold_stack(theta.reshape(shape) * data, mask, out)
+    else:
+        ll_data, ll_mask = theta.reshape(shape) * data, mask
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        log_model = numpy.log(ll_data)
+        ll_bins = -ll_data + fs_data * log_model - gammaln(fs_data + 1.0)
+    #entries where the log is undefined are left out, as with numpy.ma.log
+    ll_valid = ~(ll_mask | fs_mask | (ll_data <= 0) | ~numpy.isfinite(log_model))
+    ll = numpy.where(ll_valid, ll_bins, 0).sum(axis=tuple(range(1, data.ndim)))
+    
+    if decimals is not None:
+        ll = numpy.around(ll, decimals)
+        theta = numpy.around(theta, decimals)
+    
+    #calculate AIC
+    aic = (-2 * ll) + (2 * param_number)
+    
+    #calculate Chi^2 statistic for the folded or unfolded spectrum
+    scaled_data = theta.reshape(shape) * data
+    if fs_folded is True:
+        scaled_data, scaled_mask = fold_stack(scaled_data, mask)
+    else:
+        scaled_mask = mask
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        diff = (scaled_data - fs_data)**2
+        chi2_bins = diff / scaled_data
+    #entries where the division is not defined are left out, as with numpy.ma
+    chi2_valid = ~(scaled_mask | fs_mask | ~numpy.isfinite(chi2_bins) |
+                       (numpy.absolute(diff) * numpy.finfo(float).tiny >= numpy.absolute(scaled_data)))
+    chi2 = numpy.where(chi2_valid, chi2_bins, 0).sum(axis=tuple(range(1, data.ndim)))
+    if decimals is not None:
+        chi2 = numpy.around(chi2, decimals)
+    
+    return ll, aic, chi2, theta
+
+def write_log(outfile, model_name, rep_results, roundrep, optimizer_log=None):
+    #--------------------------------------------------------------------------------------
+    #add the replicate's optimizer log and results to the bigger log file
+    #the whole entry is put together in memory and written with a single append,
+    #so entries from parallel replicates or concurrent runs never interleave
     
     # Arguments =
     # outfile: prefix for output naming
     # model_name: a label for the output files; ex. "no_mig"
     # rep_results: the list returned by collect_results function: [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
     # roundrep: name of replicate (ex, "Round_1_Replicate_10")
+    # optimizer_log: the optimizer's progress output for this replicate, as returned by run_replicate
     #--------------------------------------------------------------------------------------
-    fh_log = open("{0}.{1}.log.txt".format(outfile, model_name), 'a')
-    fh_log.write("\n{}\n".format(roundrep))
-    templogname = "{}.log.txt".format(model_name)
-    try:
-        fh_templog = open(templogname, 'r')
-        for line in fh_templog:
-            fh_log.write(line)
-        fh_templog.close()
-    except IOError:
+    entry = ["\n{}\n".format(roundrep)]
+    if optimizer_log:
+        entry.append(optimizer_log)
+    else:
         print("Nothing written to log file this replicate...")
-    fh_log.write("likelihood = {}\n".format(rep_results[1]))
-    fh_log.write("theta = {}\n".format(rep_results[4]))
-    fh_log.write("Optimized parameters = {}\n".format(rep_results[5]))
-    fh_log.close()
+    entry.append("likelihood = {}\n".format(rep_results[1]))
+    entry.append("theta = {}\n".format(rep_results[4]))
+    entry.append("Optimized parameters = {}\n".format(rep_results[5]))
+    with open("{0}.{1}.log.txt".format(outfile, model_name), 'a') as fh_log:
+        fh_log.write("".join(entry))
+
+class SpectrumRecorder(object):
+    #--------------------------------------------------------------------------------------
+    # wrap a model function so the spectra it simulates during an optimization can be reused
+    # it remembers the spectrum of the most recently evaluated parameter vector and, when
+    # data is given, the spectrum of the best scoring parameter vector evaluated so far;
+    # the parameters returned by optimize_log_fmin are the best vertex of the final simplex,
+    # which is not always the last point the optimizer evaluated
+    
+    # Arguments
+    # func: the model function, ex. Models_3D.split_nomig
+    # data: spectrum object the optimizer is fitting, used to score each evaluation (optional)
+    #--------------------------------------------------------------------------------------
+    def __init__(self, func, data=None):
+        self.func = func
+        self.data = data
+        self.last = None
+        self.best = None
+        self.best_ll = None
+
+    def __call__(self, params, ns, *args, **kwargs):
+        sim_model = self.func(params, ns, *args, **kwargs)
+        key = tuple(float(x) for x in params)
+        self.last = (key, sim_model)
+        if self.data is not None:
+            ll = moments.Inference.ll_multinom(sim_model, self.data)
+            if not numpy.isnan(ll) and (self.best_ll is None or ll > self.best_ll):
+                self.best = (key, sim_model)
+                self.best_ll = ll
+        return sim_model
+
+    def lookup(self, params):
+        # return the remembered spectrum for exactly these parameters, or None
+        key = tuple(float(x) for x in params)
+        for recorded in (self.last, self.best):
+            if recorded is not None and recorded[0] == key:
+                return recorded[1]
+        return None
+
+class ModelCache(object):
+    #--------------------------------------------------------------------------------------
+    # memoize a model function: spectra are stored under the parameter vector rounded to
+    # a number of decimals plus the sample sizes, so repeated (or nearly repeated) evaluations
+    # are looked up instead of integrated again. The least recently used spectra are dropped
+    # once there are more than maxsize of them or they take up more than max_bytes.
+    # Hits and misses are counted and Optimize_Routine prints them for every replicate.
+    # The stored spectra are kept per process, so worker processes each build their own
+    # cache that lasts across all the replicates they run. All the caches of a process
+    # together keep at most ModelCache.max_total_bytes, beyond that the caches used least
+    # recently are dropped (a cache that is used again starts over empty).
+    
+    # Arguments
+    # func: the model function, ex. Models_3D.split_nomig
+    # decimals: number of decimals parameter values are rounded to for the cache key
+    # maxsize: maximum number of spectra to keep
+    # max_bytes: maximum memory (in bytes) taken by the stored spectra
+    #--------------------------------------------------------------------------------------
+    #the stores of the caches of this process, the least recently used first
+    _stores = OrderedDict()
+    max_total_bytes = 1024**3
+
+    def __init__(self, func, decimals=6, maxsize=128, max_bytes=512*1024**2):
+        self.func = func
+        self.decimals = int(decimals)
+        self.maxsize = int(maxsize)
+        self.max_bytes = int(max_bytes)
+        self.token = uuid.uuid4().hex
+        self._attach()
+
+    def _attach(self):
+        self._store = ModelCache._stores.setdefault(self.token, {"spectra": OrderedDict(), "nbytes": 0,
+                                                                 "hits": 0, "misses": 0})
+
+    def __getstate__(self):
+        #the stored spectra stay behind in this process
+        state = self.__dict__.copy()
+        del state["_store"]
+        #if used as a decorator the module attribute is this cache, not the function, so pickle it by name
+        module = sys.modules.get(getattr(self.func, "__module__", None))
+        if module is not None and getattr(module, self.func.__name__, None) is self:
+            state["func"] = (self.func.__module__, self.func.__name__)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["func"], tuple):
+            state["func"] = getattr(importlib.import_module(state["func"][0]), state["func"][1]).func
+        self.__dict__.update(state)
+        self._attach()
+
+    def _touch(self):
+        #move the store to the most recently used end, putting it back if it was dropped
+        self._store = ModelCache._stores.pop(self.token, self._store)
+        ModelCache._stores[self.token] = self._store
+
+    def _trim_stores(self):
+        #drop the least recently used stores of other caches until all fit in max_total_bytes
+        total = sum(store["nbytes"] for store in ModelCache._stores.values())
+        for token in list(ModelCache._stores):
+            if total <= ModelCache.max_total_bytes or token == self.token:
+                break
+            store = ModelCache._stores.pop(token)
+            total -= store["nbytes"]
+            store["spectra"].clear()
+            store["nbytes"] = 0
+
+    def __call__(self, params, ns, *args, **kwargs):
+        self._touch()
+        store = self._store
+        key = (tuple(numpy.around(numpy.asarray(params, dtype=float), self.decimals)),
+                   tuple(int(n) for n in ns))
+        if key in store["spectra"]:
+            store["hits"] += 1
+            #move the entry to the most recently used end
+            sim_model = store["spectra"].pop(key)
+            store["spectra"][key] = sim_model
+            return sim_model.copy()
+        
+        store["misses"] += 1
+        sim_model = self.func(params, ns, *args, **kwargs)
+        nbytes = sim_model.data.nbytes + numpy.ma.getmaskarray(sim_model).nbytes
+        if nbytes <= self.max_bytes and self.maxsize > 0:
+            store["spectra"][key] = sim_model.copy()
+            store["nbytes"] += nbytes
+            #evict least recently used spectra until we are within both limits
+            while len(store["spectra"]) > self.maxsize or store["nbytes"] > self.max_bytes:
+                old_key = next(iter(store["spectra"]))
+                old = store["spectra"].pop(old_key)
+                store["nbytes"] -= old.data.nbytes + numpy.ma.getmaskarray(old).nbytes
+            self._trim_stores()
+        return sim_model
+
+    def cache_info(self):
+        # return a dictionary with the hits, misses, number of stored spectra and their size in bytes
+        store = self._store
+        return {"hits": store["hits"], "misses": store["misses"],
+                "size": len(store["spectra"]), "nbytes": store["nbytes"]}
+
+    def clear(self):
+        # drop all stored spectra and reset the counters, the store is removed from the
+        # process until the cache is called again
+        store = ModelCache._stores.pop(self.token, self._store)
+        store["spectra"].clear()
+        store["nbytes"] = 0
+        store["hits"] = 0
+        store["misses"] = 0
+
+def memoize_model(func=None, decimals=6, maxsize=128, max_bytes=512*1024**2):
+    #--------------------------------------------------------------------------------------
+    # opt-in memoizing decorator for model functions, returns a ModelCache
+    # usage: func = Optimize_Functions.memoize_model(Models_3D.split_nomig, maxsize=256)
+    # or as a decorator above a model definition: @Optimize_Functions.memoize_model(decimals=8)
+    
+    # Arguments
+    # func: the model function (leave empty when used as a decorator with arguments)
+    # decimals, maxsize, max_bytes: see ModelCache
+    #--------------------------------------------------------------------------------------
+    if func is None:
+        return lambda f: ModelCache(f, decimals=decimals, maxsize=maxsize, max_bytes=max_bytes)
+    return ModelCache(func, decimals=decimals, maxsize=maxsize, max_bytes=max_bytes)
+
+class PhaseTimer(object):
+    #--------------------------------------------------------------------------------------
+    # count calls and add up the time spent in the phases of a replicate, for the optional
+    # instrumentation of Optimize_Routine. install() wraps the moments functions the models
+    # call (steady_state_1D, the Manips.split_* functions and Spectrum.integrate, timed per
+    # number of populations) and uninstall() puts the originals back, so nothing is wrapped
+    # and nothing is timed unless instrumentation is asked for
+    #--------------------------------------------------------------------------------------
+    def __init__(self):
+        self.phases = {}
+        self.originals = []
+
+    def add(self, phase, seconds):
+        counts = self.phases.setdefault(phase, {"count": 0, "seconds": 0.0})
+        counts["count"] += 1
+        counts["seconds"] += seconds
+
+    def wrap(self, phase, func):
+        # return func with every call counted and timed under phase
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(phase, timeit.default_timer() - start)
+        #a memoized model (see ModelCache) keeps reporting its cache counters through the wrapper
+        if hasattr(func, "cache_info"):
+            timed.cache_info = func.cache_info
+        return timed
+
+    def install(self):
+        targets = [(moments.LinearSystem_1D, "steady_state_1D", "steady_state")]
+        targets += [(moments.Manips, name, name) for name in dir(moments.Manips) if name.startswith("split_")]
+        for module, name, phase in targets:
+            original = getattr(module, name)
+            self.originals.append((module, name, original))
+            setattr(module, name, self.wrap(phase, original))
+        
+        integrate = moments.Spectrum.integrate
+        self.originals.append((moments.Spectrum, "integrate", integrate))
+        def timed_integrate(fs, *args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return integrate(fs, *args, **kwargs)
+            finally:
+                self.add("integrate_{}D".format(fs.ndim), timeit.default_timer() - start)
+        moments.Spectrum.integrate = timed_integrate
+
+    def uninstall(self):
+        for module, name, original in reversed(self.originals):
+            setattr(module, name, original)
+        self.originals = []
+
+#spectra opened from SharedSpectrum files in this process, most recently used last
+_shared_spectra = OrderedDict()
+
+class SharedSpectrum(object):
+    #--------------------------------------------------------------------------------------
+    # a spectrum saved once as .npy files (data and mask) for replicates that run in other
+    # processes; it pickles as just the file names, and open() maps the files read-only and
+    # rebuilds the Spectrum around them without copying, so every worker process on a node
+    # shares the same pages and memory does not grow with the number of workers.
+    # Each process keeps the spectra it opened (the `keep` most recently used ones).
+    
+    # Arguments
+    # fs: the spectrum to share
+    # folder: folder to save the files in (on a shared filesystem for the queue scheduler)
+    #--------------------------------------------------------------------------------------
+    keep = 8
+
+    def __init__(self, fs, folder):
+        name = os.path.join(folder, uuid.uuid4().hex)
+        self.datafile = name + ".data.npy"
+        self.maskfile = name + ".mask.npy"
+        numpy.save(self.datafile, numpy.asarray(fs.data))
+        numpy.save(self.maskfile, numpy.ma.getmaskarray(fs))
+        self.folded = fs.folded
+        self.pop_ids = getattr(fs, "pop_ids", None)
+
+    def open(self):
+        # return the shared spectrum as a read-only Spectrum
+        fs = _shared_spectra.pop(self.datafile, None)
+        if fs is None:
+            data = numpy.load(self.datafile, mmap_mode='r')
+            mask = numpy.load(self.maskfile, mmap_mode='r')
+            fs = moments.Spectrum(data, mask=mask, data_folded=self.folded, check_folding=False,
+                                      copy=False, pop_ids=self.pop_ids)
+            while len(_shared_spectra) >= self.keep:
+                _shared_spectra.popitem(last=False)
+        _shared_spectra[self.datafile] = fs
+        return fs
+
+    def remove(self):
+        # delete the files (processes that opened them keep their mapping)
+        _shared_spectra.pop(self.datafile, None)
+        for fname in (self.datafile, self.maskfile):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+def run_replicate(task):
+    #--------------------------------------------------------------------------------------
+    # optimize a single replicate from its perturbed starting parameters, return a tuple =
+    #(rep_results, elapsed time, cache counts, optimizer log, phases) where rep_results is the list from
+    # collect_results, cache counts are the [hits, misses] of a memoized model during this replicate
+    # (or None), optimizer log is the text the optimizer wrote to this replicate's own temporary log
+    # and phases are the PhaseTimer counts and seconds per phase (or None without instrumentation)
+    # this is a module-level function so that it can be sent to a process pool
+    
+    # Arguments
+    # task: a tuple of (fs, func, params_perturbed, lower_bound, upper_bound, maxiter,
+    #       fs_folded, roundrep, replabel, templogname, instrument, fs_fit), templogname is a file name
+    #       unique to this replicate, instrument is True to time the phases of the replicate and
+    #       fs_fit is a projected spectrum to optimize against (or None to optimize against fs);
+    #       fs and fs_fit can also be SharedSpectrum objects
+    #--------------------------------------------------------------------------------------
+    (fs, func, params_perturbed, lower_bound, upper_bound, maxiter,
+         fs_folded, roundrep, replabel, templogname, instrument, fs_fit) = task
+    if isinstance(fs, SharedSpectrum):
+        fs = fs.open()
+    if isinstance(fs_fit, SharedSpectrum):
+        fs_fit = fs_fit.open()
+    print("\t\t{}:".format(replabel))
+    
+    timer = None
+    if instrument:
+        timer = PhaseTimer()
+        timer.install()
+        func = timer.wrap("model", func)
+    try:
+        outcome = optimize_replicate(fs, func, params_perturbed, lower_bound, upper_bound, maxiter,
+                                         fs_folded, roundrep, templogname, timer, fs_fit)
+    finally:
+        if timer is not None:
+            timer.uninstall()
+    return outcome + (timer.phases if timer is not None else None,)
+
+def optimize_replicate(fs, func, params_perturbed, lower_bound, upper_bound, maxiter,
+                           fs_folded, roundrep, templogname, timer=None, fs_fit=None):
+    # the body of run_replicate, returns (rep_results, elapsed time, cache counts, optimizer log)
+    # with fs_fit, the parameters are optimized against that (projected) spectrum, and the
+    # optimized parameters are scored against the full spectrum fs like any other replicate
+    
+    #keep track of start time for rep
+    tb_rep = datetime.now()
+    
+    #counters of a memoized model function before this replicate
+    if hasattr(func, "cache_info"):
+        info = func.cache_info()
+        cache_start = [info["hits"], info["misses"]]
+    
+    print("\t\t\tStarting parameters = [{}]".format(", ".join([str(numpy.around(x, 6)) for x in params_perturbed])))
+    if fs_fit is None:
+        fs_fit = fs
+    #optimize from perturbed parameters, remembering the simulated spectra along the way
+    recorder = SpectrumRecorder(func, fs_fit)
+    if timer is not None:
+        start = timeit.default_timer()
+    params_opt = moments.Inference.optimize_log_fmin(params_perturbed, fs_fit, recorder,
+                                                         lower_bound=lower_bound, upper_bound=upper_bound,
+                                                         verbose=1, maxiter=maxiter,
+                                                         output_file=templogname)
+    if timer is not None:
+        timer.add("optimize", timeit.default_timer() - start)
+    print("\t\t\tOptimized parameters =[{}]".format(", ".join([str(numpy.around(x, 6)) for x in params_opt])))
+    
+    #read the optimizer's progress back into memory and drop the temporary file
+    try:
+        with open(templogname, 'r') as fh_templog:
+            optimizer_log = fh_templog.read()
+        os.remove(templogname)
+    except (IOError, OSError):
+        optimizer_log = ""
+
+    #reuse the spectrum the optimizer already simulated for the optimized parameters,
+    #and only simulate the model again if it was not recorded (or was simulated at projected sizes)
+    sim_model = recorder.lookup(params_opt) if fs_fit is fs else None
+    if sim_model is None:
+        sim_model = func(params_opt, fs.sample_sizes)
+
+    #collect results into a list using function above - [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
+    if timer is not None:
+        start = timeit.default_timer()
+    rep_results = collect_results(fs, sim_model, params_opt, roundrep, fs_folded)
+    if timer is not None:
+        timer.add("scoring", timeit.default_timer() - start)
+    
+    #calculate elapsed time for replicate
+    tf_rep = datetime.now()
+    te_rep = tf_rep - tb_rep
+    
+    #hits and misses of a memoized model function during this replicate
+    cache_counts = None
+    if hasattr(func, "cache_info"):
+        info = func.cache_info()
+        cache_counts = [info["hits"] - cache_start[0], info["misses"] - cache_start[1]]
+    
+    return rep_results, te_rep, cache_counts, optimizer_log
+
+def atomic_write(fname, write, mode='wb', tmp_dir=None):
+    #--------------------------------------------------------------------------------------
+    # write a file under a unique temporary name, flush it to disk and move it into place,
+    # so the file is never seen half-written and a job killed while writing leaves the
+    # previous version (the temporary file is removed if writing fails)
+    
+    # Arguments
+    # fname: name of the file
+    # write: a function called with the open temporary file, that writes the contents
+    # mode: mode the temporary file is opened with, 'wb' or 'w'
+    # tmp_dir: folder for the temporary file, on the same filesystem as fname (default is
+    #          the folder of fname)
+    #--------------------------------------------------------------------------------------
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(fname))
+    tempname = os.path.join(tmp_dir, "{0}.{1}.tmp".format(os.path.basename(fname), uuid.uuid4().hex))
+    try:
+        with open(tempname, mode) as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        #os.rename does not replace an existing file on Windows (and Python 2.7 has no os.replace)
+        if os.path.exists(fname) and sys.platform.startswith("win"):
+            os.remove(fname)
+        os.rename(tempname, fname)
+    except BaseException:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
+def write_checkpoint(checkpointname, checkpoint):
+    #--------------------------------------------------------------------------------------
+    # save the state of an optimization routine so it can be resumed later
+    # the file is written with atomic_write, so a job killed while writing never
+    # leaves a half-written checkpoint
+    
+    # Arguments
+    # checkpointname: name of the checkpoint file
+    # checkpoint: a dictionary with the keys =
+    #   settings: the [reps_list, maxiters_list, folds_list, projections_list, elite, elite_dist]
+    #             the routine was started with
+    #   round: index of the current round (starting at 0)
+    #   starts: list of perturbed starting parameters for every replicate of the current round
+    #   completed: number of replicates of the current round that are finished
+    #   best_params: the parameters the current round was perturbed from
+    #   results_list: the results of every finished replicate, across rounds
+    #   rng_state: the state of numpy's random number generator
+    #   outputs: how far the results, log and phases files had been written (see ModelRun.output_marks)
+    #--------------------------------------------------------------------------------------
+    atomic_write(checkpointname, lambda fh: pickle.dump(checkpoint, fh, protocol=2))
+
+def read_checkpoint(checkpointname):
+    #--------------------------------------------------------------------------------------
+    # load a checkpoint written by write_checkpoint, returns None if there is no checkpoint
+    
+    # Arguments
+    # checkpointname: name of the checkpoint file
+    #--------------------------------------------------------------------------------------
+    if not os.path.exists(checkpointname):
+        return None
+    with open(checkpointname, 'rb') as fh:
+        return pickle.load(fh)
+
+class ReplicateTimeout(Exception):
+    #a replicate that ran longer than its time budget and was killed
+    pass
+
+def run_replicate_caught(task):
+    #--------------------------------------------------------------------------------------
+    # target of a process pool: run_replicate(task), returns (outcome, None) or (None, error)
+    # errors come back with the result so that the pool needs only a callback (Python 2.7's
+    # Pool.apply_async has no error_callback); an error that cannot be pickled is replaced
+    # by a RuntimeError so that its replicate is not lost
+    #--------------------------------------------------------------------------------------
+    try:
+        return run_replicate(task), None
+    except Exception as error:
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(repr(error))
+        return None, error
+
+def run_killable_task(conn, func, args):
+    #--------------------------------------------------------------------------------------
+    # target of a KillablePool process: run func(*args) and send (True, result) or
+    # (False, error) back through the pipe
+    #--------------------------------------------------------------------------------------
+    try:
+        result = (True, func(*args))
+    except Exception as error:
+        result = (False, error)
+    try:
+        conn.send(result)
+    except Exception as error:
+        #the error itself could not be pickled
+        conn.send((False, RuntimeError(repr(error))))
+    conn.close()
+
+class KillablePool(object):
+    #--------------------------------------------------------------------------------------
+    # a small stand-in for multiprocessing.Pool that runs every task in its own process,
+    # so a task that runs longer than timeout seconds can be killed without losing the
+    # other workers. A killed task calls its error_callback with a ReplicateTimeout.
+    # Callbacks are run from poll(), which run_schedule calls while it waits for results.
+    
+    # Arguments
+    # processes: maximum number of tasks running at the same time
+    # timeout: seconds a task may run before it is killed (None for no limit)
+    # context: the multiprocessing context to start processes from (see pool_context),
+    #          multiprocessing's default if not given
+    #--------------------------------------------------------------------------------------
+    def __init__(self, processes=1, timeout=None, context=None):
+        self.processes = max(1, int(processes))
+        self.timeout = timeout
+        self.context = multiprocessing if context is None else context
+        self.pending = []
+        self.running = []
+
+    def apply_async(self, func, args=(), callback=None, error_callback=None):
+        self.pending.append((func, args, callback, error_callback))
+        self.start_pending()
+
+    def start_pending(self):
+        while self.pending and len(self.running) < self.processes:
+            func, args, callback, error_callback = self.pending.pop(0)
+            parent_conn, child_conn = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=run_killable_task, args=(child_conn, func, args))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            if self.timeout is None:
+                deadline = None
+            else:
+                deadline = time.time() + float(self.timeout)
+            self.running.append((process, parent_conn, deadline, callback, error_callback))
+
+    def poll(self, wait=1.0):
+        # wait up to `wait` seconds for a task to finish, then handle finished and overdue tasks
+        if self.running:
+            deadlines = [job[2] for job in self.running if job[2] is not None]
+            if deadlines:
+                wait = max(0, min([wait] + [d - time.time() for d in deadlines]))
+            conns = [job[1] for job in self.running]
+            if wait_connections is not None:
+                wait_connections(conns, timeout=wait)
+            else:
+                end = time.time() + wait
+                while time.time() < end and not any(conn.poll() for conn in conns):
+                    if not all(job[0].is_alive() for job in self.running):
+                        break
+                    time.sleep(0.05)
+        still_running = []
+        for job in self.running:
+            process, conn, deadline, callback, error_callback = job
+            if conn.poll():
+                try:
+                    ok, value = conn.recv()
+                except EOFError:
+                    ok, value = False, RuntimeError("Worker process exited without a result")
+                process.join()
+                conn.close()
+                if ok:
+                    callback(value)
+                else:
+                    error_callback(value)
+            elif deadline is not None and time.time() > deadline:
+                process.terminate()
+                process.join()
+                conn.close()
+                error_callback(ReplicateTimeout("Killed after {} seconds".format(self.timeout)))
+            elif not process.is_alive():
+                process.join()
+                conn.close()
+                error_callback(RuntimeError("Worker process exited with code {}".format(process.exitcode)))
+            else:
+                still_running.append(job)
+        self.running = still_running
+        self.start_pending()
+
+    def terminate(self):
+        self.pending = []
+        for process, conn, deadline, callback, error_callback in self.running:
+            process.terminate()
+            conn.close()
+        for job in self.running:
+            job[0].join()
+        self.running = []
+
+    def join(self):
+        pass
+
+class ResultsStore(object):
+    #--------------------------------------------------------------------------------------
+    # SQLite results file for one model, an alternative to the tab-separated .optimized.txt
+    # every replicate is a row of the 'results' table with typed columns:
+    #   model, replicate, round_num, rep_num, ll, aic, chi2, theta, and one REAL column per parameter
+    #   (named after param_labels when they give one unique label per parameter, else p1, p2, ...)
+    # notes (ex. rounds stopped early, timed out replicates) go to the 'notes' table
+    # rows are buffered and written in a single transaction by flush()
+    
+    # Arguments
+    # dbname: name of the SQLite file, ex. "{outfile}.{model_name}.optimized.sqlite"
+    # param_number: number of parameters in the model
+    # param_labels: labels for the parameters, ex. "nu1, nu2, nu3, T1"
+    #--------------------------------------------------------------------------------------
+    def __init__(self, dbname, param_number, param_labels=" "):
+        self.dbname = dbname
+        self.conn = sqlite3.connect(dbname)
+        labels = [x.strip() for x in str(param_labels).split(",")]
+        if len(labels) != int(param_number) or len(set(labels)) != len(labels) or "" in labels:
+            labels = ["p{}".format(i+1) for i in range(int(param_number))]
+        self.param_columns = labels
+        columns = ", ".join('"{}" REAL'.format(x.replace('"', '""')) for x in labels)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (model TEXT, replicate TEXT, round_num INTEGER, rep_num INTEGER, "
+                                  "ll REAL, aic REAL, chi2 REAL, theta REAL, {})".format(columns))
+            self.conn.execute("CREATE TABLE IF NOT EXISTS notes (model TEXT, note TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('param_labels', ?)", (str(param_labels),))
+        self.rows = []
+        self.notes = []
+
+    def add(self, model_name, rep_results):
+        # buffer a row from the list returned by collect_results
+        roundrep = str(rep_results[0]).split("_")
+        self.rows.append([model_name, rep_results[0], int(roundrep[1]), int(roundrep[3]),
+                              float(rep_results[1]), float(rep_results[2]), float(rep_results[3]),
+                              float(rep_results[4])] + [float(x) for x in rep_results[5]])
+
+    def add_note(self, model_name, note):
+        self.notes.append((model_name, note))
+
+    def flush(self):
+        # write every buffered row and note in one transaction
+        if self.rows or self.notes:
+            with self.conn:
+                if self.rows:
+                    self.conn.executemany("INSERT INTO results VALUES ({})".format(", ".join(["?"] * len(self.rows[0]))), self.rows)
+                if self.notes:
+                    self.conn.executemany("INSERT INTO notes VALUES (?, ?)", self.notes)
+            self.rows = []
+            self.notes = []
+
+    def marks(self):
+        # the last rowid of the results and notes tables, to roll back to with rollback()
+        return [self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM {}".format(table)).fetchone()[0]
+                    for table in ("results", "notes")]
+
+    def rollback(self, marks):
+        # delete the rows and notes written after marks
+        with self.conn:
+            for table, mark in zip(("results", "notes"), marks):
+                self.conn.execute("DELETE FROM {} WHERE rowid > ?".format(table), (mark,))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def load_results(dbname):
+    #--------------------------------------------------------------------------------------
+    # read the results table of a ResultsStore file into a numpy record array, with one field
+    # per column (model, replicate, round_num, rep_num, ll, aic, chi2, theta, and the parameters)
+    
+    # Arguments
+    # dbname: name of the SQLite results file
+    #--------------------------------------------------------------------------------------
+    conn = sqlite3.connect(dbname)
+    try:
+        cursor = conn.execute("SELECT * FROM results ORDER BY rowid")
+        names = [x[0] for x in cursor.description]
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    dtype = list(zip(names, ["U64", "U64", "i8", "i8"] + ["f8"] * (len(names) - 4)))
+    if not rows:
+        return numpy.recarray(0, dtype=dtype)
+    return numpy.rec.fromrecords(rows, dtype=dtype)
+
+def export_results_text(dbname, outname=None):
+    #--------------------------------------------------------------------------------------
+    # export a ResultsStore file to the tab-separated format of the .optimized.txt files,
+    # so it can be read by Summarize_Outputs.py, notes are written after the results on lines
+    # starting with '#'. Returns the name of the text file.
+    
+    # Arguments
+    # dbname: name of the SQLite results file
+    # outname: name of the text file, default is dbname with .sqlite replaced by .txt
+    #--------------------------------------------------------------------------------------
+    if outname is None:
+        outname = "{}.txt".format(dbname[:-len(".sqlite")] if dbname.endswith(".sqlite") else dbname)
+    conn = sqlite3.connect(dbname)
+    try:
+        param_labels = conn.execute("SELECT value FROM meta WHERE key = 'param_labels'").fetchone()[0]
+        rows = conn.execute("SELECT * FROM results ORDER BY rowid").fetchall()
+        notes = conn.execute("SELECT * FROM notes ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+    lines = ["Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params({})\n".format(param_labels)]
+    for row in rows:
+        easy_p = ",".join(str(numpy.around(x, 4)) for x in row[8:])
+        lines.append("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(row[0], row[1], row[4], row[5], row[6], row[7], easy_p))
+    for model_name, note in notes:
+        lines.append("# {0}: {1}\n".format(model_name, note))
+    with open(outname, 'w') as fh_out:
+        fh_out.write("".join(lines))
+    return outname
+
+def elite_pool(results_list, size, min_dist=0.1):
+    #--------------------------------------------------------------------------------------
+    # return the parameter sets of up to `size` of the best replicates that are distinct from
+    # each other, best first: going down the replicates by log-likelihood, a parameter set is
+    # kept only if its root mean square log10 distance to every set kept so far is at least
+    # min_dist (0.1 is about a 26% difference per parameter)
+    
+    # Arguments
+    # results_list: list of replicate results from collect_results
+    # size: maximum number of parameter sets to return
+    # min_dist: minimum distance between parameter sets in log10 units
+    #--------------------------------------------------------------------------------------
+    elites, logs = [], []
+    for result in sorted(results_list, key=lambda x: float(x[1]), reverse=True):
+        log_params = numpy.log10(numpy.asarray(result[5], dtype=float))
+        if all(numpy.sqrt(numpy.mean((log_params - other)**2)) >= min_dist for other in logs):
+            elites.append(result[5])
+            logs.append(log_params)
+            if len(elites) >= int(size):
+                break
+    return elites
+
+class ModelRun(object):
+    #--------------------------------------------------------------------------------------
+    # the state of the optimization routine for one model, stepped through by run_schedule:
+    # start_round perturbs the starting parameters and returns the replicate tasks of the next
+    # round, add_outcome takes back finished replicates (in any order) and records them in
+    # replicate order, and end_round sorts the results once every replicate of the round is in
+    
+    # Arguments
+    # see Optimize_Routine, plus:
+    # converge_reps, converge_tol: early stopping policy, see Optimize_Routine
+    # results_store: "text" or "sqlite", see Optimize_Routine
+    # instrument: time the phases of every replicate, see Optimize_Routine
+    # elite, elite_dist: start the replicates of later rounds from an elite pool, see Optimize_Routine
+    # projections: sample sizes to project the spectrum to in each round, see Optimize_Routine
+    # rng_state: if given, the model draws its starting parameters from its own random number
+    #            state instead of numpy's global one (used when several models share a pool)
+    #--------------------------------------------------------------------------------------
+    def __init__(self, fs, outfile, model_name, func, rounds, param_number, fs_folded=True,
+                     reps=None, maxiters=None, folds=None, in_params=None,
+                     in_upper=None, in_lower=None, param_labels=" ",
+                     checkpoint=False, resume=False, rng_state=None,
+                     converge_reps=None, converge_tol=0.1, results_store="text", instrument=False,
+                     elite=None, elite_dist=0.1, projections=None):
+        self.fs = fs
+        self.outfile = outfile
+        self.model_name = model_name
+        self.func = func
+        self.rounds = int(rounds)
+        self.param_number = int(param_number)
+        self.fs_folded = fs_folded
+        self.rng_state = rng_state
+        self.converge_reps = converge_reps
+        self.converge_tol = float(converge_tol)
+        self.instrument = instrument
+        self.elite = elite
+        self.elite_dist = float(elite_dist)
+        self.phasesname = "{0}.{1}.phases.jsonl".format(outfile, model_name)
+        #folder for SharedSpectrum files while replicates run in other processes, see share
+        self.share_dir = None
+        self.shared = {}
+
+        #call function that determines if our params and bounds have been set or need to be generated for us
+        self.params, self.upper_bound, self.lower_bound = parse_params(param_number, in_params, in_upper, in_lower)
+
+        #call function that determines if our replicates, maxiter, and fold have been set or need to be generated for us
+        self.reps_list, self.maxiters_list, self.folds_list = parse_opt_settings(rounds, reps, maxiters, folds)
+        self.projections_list = parse_projections(rounds, projections, fs.sample_sizes)
+    
+        print("\n\n============================================================================\nModel {}\n============================================================================".format(model_name))
+
+        #start keeping track of time it takes to complete optimizations for this model
+        self.tb_round = datetime.now()
+    
+        #load the state of a previous run if we are resuming one
+        self.checkpointname = "{0}.{1}.checkpoint.pkl".format(outfile, model_name)
+        self.checkpoint = checkpoint
+        self.state = None
+        if resume:
+            self.checkpoint = True
+            self.state = read_checkpoint(self.checkpointname)
+        #the settings a resumed run must share with its checkpoint (elite_dist only matters with an elite pool)
+        self.settings = [list(self.reps_list), list(self.maxiters_list), list(self.folds_list),
+                             list(self.projections_list), self.elite, self.elite_dist if self.elite is not None else None]
+        if self.state is not None:
+            stored = list(self.state["settings"])
+            #checkpoints from before projections and elite pools were stored ran without them
+            stored += [[None] * self.rounds, None, None][len(stored)-3:]
+            if stored != self.settings:
+                raise ValueError("Optimization settings do not match those stored in the checkpoint: {}".format(self.checkpointname))
+            print("\tResuming from checkpoint: Round {0}, {1} replicates finished".format(self.state["round"]+1, self.state["completed"]))
+            self.set_rng_state(self.state["rng_state"])
+    
+        # We need an output file that will store all summary info for each replicate, across rounds
+        # (a resumed run keeps adding to the file it already started)
+        self.outname = "{0}.{1}.optimized.txt".format(outfile,model_name)
+        if results_store == "sqlite":
+            self.store = ResultsStore("{0}.{1}.optimized.sqlite".format(outfile, model_name), param_number, param_labels)
+        elif results_store == "text":
+            self.store = None
+            if self.state is None:
+                with open(self.outname, 'a') as fh_out:
+                    fh_out.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params({})\n".format(param_labels))
+        else:
+            raise ValueError("Unknown results_store, use 'text' or 'sqlite': {}".format(results_store))
+        if self.state is not None:
+            self.rewind_outputs(self.state.get("outputs"))
+    
+        #Create list to store sublists of [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values] for every replicate
+        if self.state is None:
+            self.results_list = []
+            self.round = 0
+            self.previous_best = None
+        else:
+            self.results_list = self.state["results_list"]
+            self.round = self.state["round"]
+            self.previous_best = self.state.get("previous_best")
+        self.finished = self.round >= self.rounds
+
+    def get_rng_state(self):
+        if self.rng_state is not None:
+            return self.rng_state
+        return numpy.random.get_state()
+
+    def set_rng_state(self, rng_state):
+        if self.rng_state is not None:
+            self.rng_state = rng_state
+        else:
+            numpy.random.set_state(rng_state)
+
+    def start_round(self):
+        # perturb the starting parameters of the current round and return its replicate tasks
+        r = self.round
+        print("\tBeginning Optimizations for Round {0} ({1}):".format(r+1, self.model_name))
+       
+        #a round interrupted part way through continues from its stored starting parameters
+        if self.state is not None and r == self.state["round"] and self.state["starts"] is not None:
+            self.best_params = self.state["best_params"]
+            self.starts = self.state["starts"]
+            self.completed = self.state["completed"]
+        else:
+            #make sure first round params are assigned (either user input or auto generated)
+            if r == int(0):
+                self.best_params = self.params
+            #and that all subsequent rounds use the params from a previous best scoring replicate
+            #(if every replicate so far timed out, start again from the initial params)
+            elif self.results_list:
+                self.best_params = self.results_list[0][5]
+            else:
+                self.best_params = self.params
+            
+            #with an elite pool, the replicates take turns starting from the best distinct parameter sets
+            bases = [self.best_params]
+            if self.elite is not None and r > 0 and self.results_list:
+                bases = elite_pool(self.results_list, self.elite, self.elite_dist)
+                print("\tStarting from an elite pool of {0} parameter sets".format(len(bases)))
+
+            #perturb starting parameters for every replicate of this round up front, in replicate order,
+            #so the random number stream is consumed exactly as in a serial run
+            #(a model with its own random state swaps it in for the duration)
+            if self.rng_state is not None:
+                global_state = numpy.random.get_state()
+                numpy.random.set_state(self.rng_state)
+            self.starts = [moments.Misc.perturb_params(bases[rep % len(bases)], fold=self.folds_list[r],
+                                                           upper_bound=self.upper_bound, lower_bound=self.lower_bound)
+                               for rep in range(self.reps_list[r])]
+            if self.rng_state is not None:
+                self.rng_state = numpy.random.get_state()
+                numpy.random.set_state(global_state)
+            self.completed = 0
+
+        #a coarse round optimizes against the spectrum projected to smaller sample sizes
+        fs_fit = None
+        if self.projections_list[r] is not None:
+            fs_fit = self.fs.project(self.projections_list[r])
+            print("\tOptimizing against the spectrum projected to {}".format(self.projections_list[r]))
+            fs_fit = self.shared_spectrum(tuple(self.projections_list[r]), fs_fit)
+
+        self.stopped = False
+        self.outcomes = {}
+        tasks = []
+        for rep in range(self.completed+1, (self.reps_list[r]+1) ):
+            params_perturbed = self.starts[rep-1]
+            roundrep = "Round_{0}_Replicate_{1}".format(r+1, rep)
+            replabel = "Round {0} Replicate {1} of {2}".format(r+1, rep, (self.reps_list[r]))
+            #every replicate gets its own temporary optimizer log, so parallel replicates
+            #and concurrent runs of the same model never write to the same file; the file is
+            #only created once the optimizer writes to it, so a replicate that never runs
+            #(dropped from a stopped round, or still waiting after an error) leaves nothing behind
+            templogname = os.path.join(tempfile.gettempdir(), "{0}.{1}.{2}.log.txt".format(
+                self.model_name, roundrep, uuid.uuid4().hex))
+            tasks.append((self.shared_spectrum(None, self.fs), self.func, params_perturbed, self.lower_bound, self.upper_bound,
+                              self.maxiters_list[r], self.fs_folded, roundrep, replabel, templogname,
+                              self.instrument, fs_fit))
+        return tasks
+
+    def share(self, folder):
+        # hand the spectrum to replicates as SharedSpectrum files in folder from now on
+        self.share_dir = folder
+
+    def shared_spectrum(self, key, fs):
+        # the SharedSpectrum for fs (saved once per key, None for the full spectrum) when sharing, else fs itself
+        if self.share_dir is None:
+            return fs
+        if key not in self.shared:
+            self.shared[key] = SharedSpectrum(fs, self.share_dir)
+        return self.shared[key]
+
+    def unshare(self):
+        # delete the SharedSpectrum files
+        for shared in self.shared.values():
+            shared.remove()
+        self.shared = {}
+        self.share_dir = None
+
+    def add_outcome(self, rnd, rep, task, outcome):
+        # take back a finished replicate (round index, replicate numbered from 1), and record
+        # every replicate that is now complete in replicate order
+        if rnd != self.round or self.stopped:
+            #left over from a round that was stopped early, so it is not used
+            if os.path.exists(task[9]):
+                os.remove(task[9])
+            return
+        self.outcomes[rep] = (task, outcome)
+        while (self.completed+1) in self.outcomes and not self.stopped:
+            task, outcome = self.outcomes.pop(self.completed+1)
+            self.record_replicate(task, outcome)
+            self.check_convergence()
+        if self.stopped:
+            self.discard_outcomes()
+
+    def discard_outcomes(self):
+        for task, outcome in self.outcomes.values():
+            if os.path.exists(task[9]):
+                os.remove(task[9])
+        self.outcomes = {}
+
+    def round_complete(self):
+        return self.stopped or self.completed >= self.reps_list[self.round]
+
+    def write_note(self, note):
+        # record a note (ex. a skipped round) in the results file, on a line starting with '#'
+        print("\t{}".format(note))
+        if self.store is not None:
+            self.store.add_note(self.model_name, note)
+            return
+        with open(self.outname, 'a') as fh_out:
+            fh_out.write("# {0}: {1}\n".format(self.model_name, note))
+
+    def check_convergence(self):
+        # stop the round once converge_reps of its replicates are within converge_tol of the best ll so far
+        if self.converge_reps is None or self.completed >= self.reps_list[self.round] or not self.results_list:
+            return
+        best_ll = max(float(x[1]) for x in self.results_list)
+        #only the replicates this round produced (timed out replicates count as completed but have no results)
+        label = "Round_{}_".format(self.round+1)
+        round_results = [x for x in self.results_list if x[0].startswith(label)]
+        close = len([x for x in round_results if float(x[1]) >= best_ll - self.converge_tol])
+        if close >= int(self.converge_reps):
+            self.stopped = True
+            self.write_note("Round {0} stopped after replicate {1} of {2}: {3} replicates within {4} of best ll = {5}".format(
+                self.round+1, self.completed, self.reps_list[self.round], close, self.converge_tol, best_ll))
+
+    def record_replicate(self, task, outcome):
+        if isinstance(outcome, ReplicateTimeout):
+            self.record_timeout(task, outcome)
+            return
+        rep_results, te_rep, cache_counts, optimizer_log, phases = outcome
+        roundrep = task[7]
+        if phases is not None:
+            start = timeit.default_timer()
+            
+        #add the replicate's optimizer log to the bigger log file
+        write_log(self.outfile, self.model_name, rep_results, roundrep, optimizer_log)
+            
+        #append results from this sim to larger list
+        self.results_list.append(rep_results)
+            
+        #write all this info to our main results file (or buffer it for the results store)
+        if self.store is not None:
+            self.store.add(self.model_name, rep_results)
+        else:
+            with open(self.outname, 'a') as fh_out:
+                #join the param values together with commas
+                easy_p = ",".join(str(numpy.around(x, 4)) for x in rep_results[5])
+                fh_out.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(self.model_name, rep_results[0],
+                                                                              rep_results[1], rep_results[2],
+                                                                              rep_results[3], rep_results[4],
+                                                                              easy_p))
+        
+        if phases is not None:
+            phases["log_io"] = {"count": 1, "seconds": timeit.default_timer() - start}
+            self.write_phases(roundrep, te_rep, phases)
+
+        print("\n\t\t\tReplicate time: {0} (H:M:S)".format(te_rep))
+        if cache_counts is not None:
+            print("\t\t\tModel cache: {0} hits, {1} misses".format(cache_counts[0], cache_counts[1]))
+        print("")
+        self.save_progress()
+
+    def write_phases(self, roundrep, te_rep, phases):
+        # append the instrumentation of a replicate to the phases file, as one JSON line
+        line = {"model": self.model_name, "replicate": roundrep, "seconds": te_rep.total_seconds(),
+                "model_calls": phases.get("model", {}).get("count", 0), "phases": phases}
+        with open(self.phasesname, 'a') as fh_phases:
+            fh_phases.write(json.dumps(line, sort_keys=True) + "\n")
+
+    def record_timeout(self, task, error):
+        # note a replicate that was killed for running past its time budget, with its starting parameters
+        params_perturbed, roundrep, templogname = task[2], task[7], task[9]
+        easy_p = ",".join(str(numpy.around(x, 4)) for x in params_perturbed)
+        self.write_note("{0} timed out ({1}), starting parameters = {2}".format(roundrep, error, easy_p))
+        with open("{0}.{1}.log.txt".format(self.outfile, self.model_name), 'a') as fh_log:
+            fh_log.write("\n{0}\ntimed out ({1})\nStarting parameters = {2}\n".format(roundrep, error, easy_p))
+        if os.path.exists(templogname):
+            os.remove(templogname)
+        self.save_progress()
+
+    def save_progress(self):
+        #save our progress so a killed job can pick up after this replicate
+        self.completed += 1
+        if self.checkpoint:
+            self.save_state(self.starts, self.completed, self.best_params)
+
+    def save_state(self, starts, completed, best_params):
+        #write the buffered results, then a checkpoint that matches them
+        if self.store is not None:
+            self.store.flush()
+        write_checkpoint(self.checkpointname, {"settings": self.settings,
+                                               "round": self.round, "starts": starts, "completed": completed,
+                                               "best_params": best_params, "results_list": self.results_list,
+                                               "rng_state": self.get_rng_state(), "previous_best": self.previous_best,
+                                               "outputs": self.output_marks()})
+
+    def output_files(self):
+        # the text files the replicates are written to, by kind
+        files = {"log": "{0}.{1}.log.txt".format(self.outfile, self.model_name), "phases": self.phasesname}
+        if self.store is None:
+            files["results"] = self.outname
+        return files
+
+    def output_marks(self):
+        # how far the output files have been written, saved with every checkpoint
+        marks = {}
+        for kind, fname in self.output_files().items():
+            marks[kind] = os.path.getsize(fname) if os.path.exists(fname) else 0
+        if self.store is not None:
+            marks["store"] = self.store.marks()
+        return marks
+
+    def rewind_outputs(self, marks):
+        # cut the output files back to where they were at the checkpoint, so replicates a killed
+        # job wrote after its last checkpoint are not written twice when they run again
+        if marks is None:
+            #a checkpoint from before output marks were saved
+            return
+        for kind, fname in self.output_files().items():
+            if kind in marks and os.path.exists(fname) and os.path.getsize(fname) > marks[kind]:
+                with open(fname, 'r+b') as fh:
+                    fh.truncate(marks[kind])
+        if self.store is not None and "store" in marks:
+            self.store.rollback(marks["store"])
+
+    def end_round(self):
+        if not self.results_list:
+            #every replicate so far timed out, there is nothing to sort yet
+            self.write_note("Round {} finished without any replicate results".format(self.round+1))
+            self.round += 1
+            if self.store is not None:
+                self.store.flush()
+            if self.checkpoint:
+                self.save_state(None, 0, self.params)
+            self.finished = self.round >= self.rounds
+            return
+        
+        #Now that this round is over, sort results in order of likelihood score
+        #we'll use the parameters from the best rep to start the next round
+        self.results_list.sort(key=lambda x: float(x[1]), reverse=True)
+        print("\tBest so far ({0}): {1}, ll = {2}\n\n".format(self.model_name, self.results_list[0][0], self.results_list[0][1]))
+            
+        #with early stopping, skip the remaining rounds if this round did not improve the best ll
+        best_ll = float(self.results_list[0][1])
+        finished_round = self.round
+        self.round += 1
+        if (self.converge_reps is not None and self.previous_best is not None and self.round < self.rounds
+                and best_ll - self.previous_best <= self.converge_tol):
+            self.write_note("Rounds {0} to {1} skipped: best ll = {2} improved by no more than {3} in Round {4}".format(
+                self.round+1, self.rounds, best_ll, self.converge_tol, finished_round+1))
+            self.round = self.rounds
+        self.previous_best = best_ll
+        
+        #write the round's results in one batch
+        if self.store is not None:
+            self.store.flush()
+        
+        #mark the round as finished, the next round is perturbed from the sorted results
+        if self.checkpoint:
+            self.save_state(None, 0, self.results_list[0][5])
+        self.finished = self.round >= self.rounds
+
+    def finish(self):
+        #Now that all rounds are over, calculate elapsed time for the whole model
+        tf_round = datetime.now()
+        te_round = tf_round - self.tb_round
+        print("\n{0} Analysis Time for Model: {1} (H:M:S)\n\n"
+                  "============================================================================".format(self.model_name, te_round))
+        
+        #write the text version of the results store for Summarize_Outputs.py
+        if self.store is not None:
+            self.store.close()
+            export_results_text(self.store.dbname, self.outname)
+
+class ProgressReporter(object):
+    #--------------------------------------------------------------------------------------
+    # report the progress of a schedule after every finished replicate, as a status dictionary =
+    # {"updated", "elapsed_seconds", "completed", "total", "mean_replicate_seconds", "eta_seconds",
+    #  "best_ll", "finished", "models": [{"model", "round", "rounds", "completed", "total", "best_ll",
+    #  "finished"}, ...]}
+    # per model, completed/total count the replicates of its current round; the overall total
+    # assumes every remaining round runs all its replicates (early stopping can only shorten it).
+    # The ETA is the number of replicates left times the mean replicate time, divided by the workers.
+    
+    # Arguments
+    # runs: list of ModelRun objects
+    # workers: the number of replicates running at once
+    # progress: a function called with the status dictionary, or the name of a status file
+    #           that is replaced (never half-written) on every update
+    #--------------------------------------------------------------------------------------
+    def __init__(self, runs, workers=1, progress=None):
+        self.runs = runs
+        self.workers = max(1, int(workers))
+        self.callback = progress if callable(progress) else None
+        self.status_file = None if callable(progress) else progress
+        self.start = timeit.default_timer()
+        self.completed = 0
+        self.replicate_seconds = 0.
+        self.timed = 0
+
+    def replicate_done(self, outcome):
+        # count a finished replicate (a timed out replicate counts, but not towards the mean time)
+        self.completed += 1
+        if not isinstance(outcome, ReplicateTimeout):
+            self.replicate_seconds += outcome[1].total_seconds()
+            self.timed += 1
+
+    def status(self):
+        models = []
+        remaining = 0
+        for run in self.runs:
+            best_ll = max(float(x[1]) for x in run.results_list) if run.results_list else None
+            if run.finished:
+                completed, total = 0, 0
+            else:
+                #replicates that finished ahead of their turn are waiting in run.outcomes
+                completed = getattr(run, "completed", 0) + len(getattr(run, "outcomes", {}))
+                total = run.reps_list[run.round]
+                if not getattr(run, "stopped", False):
+                    remaining += total - completed
+                remaining += sum(run.reps_list[run.round+1:])
+            models.append({"model": run.model_name, "round": min(run.round+1, run.rounds), "rounds": run.rounds,
+                           "completed": completed, "total": total, "best_ll": best_ll, "finished": run.finished})
+        lls = [m["best_ll"] for m in models if m["best_ll"] is not None]
+        mean = self.replicate_seconds / self.timed if self.timed else None
+        return {"updated": datetime.now().isoformat(), "elapsed_seconds": timeit.default_timer() - self.start,
+                "completed": self.completed, "total": self.completed + remaining,
+                "mean_replicate_seconds": mean,
+                "eta_seconds": None if mean is None else remaining * mean / self.workers,
+                "best_ll": max(lls) if lls else None,
+                "finished": all(run.finished for run in self.runs), "models": models}
+
+    def update(self):
+        # report the current status to the callback or the status file
+        status = self.status()
+        if self.callback is not None:
+            self.callback(status)
+        if self.status_file is not None:
+            write_status(self.status_file, status)
+
+def write_status(fname, status):
+    # replace the status file in one step (see atomic_write)
+    atomic_write(fname, lambda fh: json.dump(status, fh, indent=1), mode='w')
+
+class ReplicateQueue(object):
+    #--------------------------------------------------------------------------------------
+    # the waiting replicates of a set of ModelRuns, shared by run_schedule and run_schedule_async
+    # waiting replicates are handed out cheapest model first (by number of parameters), and a
+    # model starts its next round as soon as its own round is over, so free workers pick up
+    # replicates of other models instead of waiting at a round boundary
+    
+    # Arguments
+    # runs: list of ModelRun objects
+    # progress: a ProgressReporter, or None
+    #--------------------------------------------------------------------------------------
+    def __init__(self, runs, progress=None):
+        self.runs = runs
+        self.progress = progress
+        #waiting replicates, sorted by (parameter number, model order, round, replicate number)
+        self.waiting = []
+        for i in range(len(runs)):
+            self.queue_round(i)
+        if progress is not None:
+            progress.update()
+
+    def queue_round(self, i):
+        run = self.runs[i]
+        while not run.finished:
+            tasks = run.start_round()
+            if tasks:
+                first = run.completed + 1
+                for rep, task in enumerate(tasks, first):
+                    heapq.heappush(self.waiting, (run.param_number, i, run.round, rep, task))
+                return
+            #every replicate of this round was already finished (resuming a checkpoint)
+            run.end_round()
+        run.finish()
+
+    def pop(self):
+        # return the cheapest waiting replicate as (model index, round, replicate number, task)
+        param_number, i, rnd, rep, task = heapq.heappop(self.waiting)
+        return i, rnd, rep, task
+
+    def record(self, i, rnd, rep, task, outcome):
+        # hand a finished replicate back to its model, and queue the model's next round once this one is over
+        run = self.runs[i]
+        run.add_outcome(rnd, rep, task, outcome)
+        if not run.finished and rnd == run.round and run.round_complete():
+            #drop replicates of a round that was stopped early before they start
+            self.waiting[:] = [w for w in self.waiting if w[1] != i]
+            heapq.heapify(self.waiting)
+            run.end_round()
+            self.queue_round(i)
+        if self.progress is not None:
+            self.progress.replicate_done(outcome)
+            self.progress.update()
+
+def run_schedule(runs, pool=None, workers=1, progress=None):
+    #--------------------------------------------------------------------------------------
+    # run every round of every ModelRun, keeping up to `workers` replicates in the pool at once
+    # (see ReplicateQueue for the order replicates are handed out in)
+    
+    # Arguments
+    # runs: list of ModelRun objects
+    # pool: a multiprocessing pool or KillablePool, or None to run every replicate in this process
+    # workers: the number of processes in the pool
+    # progress: a ProgressReporter updated after every replicate, or None
+    #--------------------------------------------------------------------------------------
+    queue = ReplicateQueue(runs, progress)
+    done = Queue.Queue()
+    running = 0
+    while queue.waiting or running:
+        if pool is None:
+            #serial, run the cheapest waiting replicate right here
+            i, rnd, rep, task = queue.pop()
+            done.put((i, rnd, rep, task, run_replicate(task), None))
+        else:
+            #top up the pool with the cheapest waiting replicates
+            while queue.waiting and running < workers:
+                i, rnd, rep, task = queue.pop()
+                kwargs = {}
+                if isinstance(pool, KillablePool):
+                    #a KillablePool reports the replicates it killed through error_callback
+                    kwargs["error_callback"] = lambda error, i=i, rnd=rnd, rep=rep, task=task: done.put((i, rnd, rep, task, None, error))
+                pool.apply_async(run_replicate_caught, (task,),
+                                     callback=lambda result, i=i, rnd=rnd, rep=rep, task=task: done.put((i, rnd, rep, task) + tuple(result)),
+                                     **kwargs)
+                running += 1
+            running -= 1
+            #a KillablePool only runs its callbacks (and kills overdue replicates) when polled
+            if hasattr(pool, "poll"):
+                while done.empty():
+                    pool.poll()
+        i, rnd, rep, task, outcome, error = done.get()
+        if isinstance(error, ReplicateTimeout):
+            #a timed out replicate is recorded, and the rest of the round keeps going
+            outcome, error = error, None
+        if error is not None:
+            raise error
+        queue.record(i, rnd, rep, task, outcome)
+
+def run_schedule_async(runs, workers=1, progress=None, keep=False, preload=()):
+    #--------------------------------------------------------------------------------------
+    # run every round of every ModelRun like run_schedule, from an asyncio event loop: up to
+    # `workers` replicates run in executor workers (processes, or one thread for a single worker)
+    # and the loop records each one as its completion event arrives, so progress reporting
+    # happens in this process between events and never holds up the workers.
+    # Replicates are handed out and recorded exactly as by run_schedule, so the output is the
+    # same. Requires Python 3.
+    
+    # Arguments
+    # runs: list of ModelRun objects
+    # workers: the number of replicates running at once
+    # progress: a ProgressReporter updated after every replicate, or None
+    # keep, preload: reuse the executor kept open for the session, see start_pool
+    #--------------------------------------------------------------------------------------
+    if asyncio is None:
+        raise ValueError("The asyncio scheduler requires Python 3, use scheduler='pool'")
+    workers = int(workers)
+    queue = ReplicateQueue(runs, progress)
+    if workers > 1 and keep:
+        executor = session_pool("executor", workers, preload)
+    elif workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.new_event_loop()
+    running = {}
+    try:
+        while queue.waiting or running:
+            #top up the executor with the cheapest waiting replicates
+            while queue.waiting and len(running) < workers:
+                i, rnd, rep, task = queue.pop()
+                running[loop.run_in_executor(executor, run_replicate, task)] = (i, rnd, rep, task)
+            #wait for the next completion events
+            finished, pending = loop.run_until_complete(asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED))
+            #several replicates can finish together, record them in model and replicate order
+            for future in sorted(finished, key=lambda f: running[f][:3]):
+                i, rnd, rep, task = running.pop(future)
+                queue.record(i, rnd, rep, task, future.result())
+    finally:
+        for future in running:
+            future.cancel()
+        if executor not in _session_pools.values():
+            executor.shutdown(wait=False)
+        loop.close()
+
+def queue_dirs(queue_dir):
+    #--------------------------------------------------------------------------------------
+    # return the folders of a shared-filesystem work queue as a dictionary, creating them if needed =
+    # tasks: replicates waiting to be claimed, claimed: replicates a worker is running,
+    # results: finished replicates, tmp: files being written (moved into place once complete),
+    # spectra: the SharedSpectrum files of the coordinators
+    #--------------------------------------------------------------------------------------
+    dirs = dict((name, os.path.join(queue_dir, name)) for name in ("tasks", "claimed", "results", "tmp", "spectra"))
+    for path in dirs.values():
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                #another process created it first
+                if not os.path.isdir(path):
+                    raise
+    return dirs
+
+def publish_file(fname, obj, tmp_dir):
+    # pickle obj to a uniquely named file in tmp_dir and move it to fname, so a file seen under
+    # its final name on the shared filesystem is always complete
+    atomic_write(fname, lambda fh: pickle.dump(obj, fh, protocol=2), tmp_dir=tmp_dir)
+
+def run_schedule_queue(runs, queue_dir, timeout=None, progress=None, poll=1.0):
+    #--------------------------------------------------------------------------------------
+    # run every round of every ModelRun through a work queue on a shared filesystem, for replicates
+    # run by worker processes on any number of nodes (see run_queue_worker and Queue_Worker.py)
+    # the replicates of a round are published as task files named so that a sorted listing gives
+    # the cheapest model first, workers claim them by renaming them into claimed/ and write their
+    # outcome to results/, and this coordinator records the results (in replicate order, so the
+    # output is the same as a serial run) and publishes the next round of each model as soon as
+    # its round is over. Several coordinators can share a queue folder.
+    
+    # Arguments
+    # runs: list of ModelRun objects
+    # queue_dir: the shared queue folder
+    # timeout: seconds a claimed replicate may run before it is recorded as timed out (None for no limit),
+    #          a result that comes in later (or never, from a worker that died) is ignored
+    # progress: a ProgressReporter updated after every replicate, or None
+    # poll: seconds to wait between looks at the results folder
+    #--------------------------------------------------------------------------------------
+    dirs = queue_dirs(queue_dir)
+    #every file of this coordinator ends with its own id
+    coordinator = uuid.uuid4().hex[:12]
+    queue = ReplicateQueue(runs, progress)
+    #published replicates, by key
+    published = {}
+    seq = 0
+    try:
+        while queue.waiting or published:
+            #publish every waiting replicate
+            while queue.waiting:
+                i, rnd, rep, task = queue.pop()
+                key = "{0:03d}-{1:09d}-{2}".format(runs[i].param_number, seq, coordinator)
+                seq += 1
+                publish_file(os.path.join(dirs["tasks"], key + ".task"), task, dirs["tmp"])
+                published[key] = (i, rnd, rep, task)
+            
+            #collect the results that came in
+            found = sorted(f for f in os.listdir(dirs["results"]) if f.endswith(coordinator + ".result"))
+            for fname in found:
+                key = fname[:-len(".result")]
+                with open(os.path.join(dirs["results"], fname), 'rb') as fh:
+                    outcome, error = pickle.load(fh)
+                os.remove(os.path.join(dirs["results"], fname))
+                if key not in published:
+                    #a late result of a replicate that timed out or was withdrawn
+                    continue
+                i, rnd, rep, task = published.pop(key)
+                #a worker on this node shares the temporary folder, and a replicate that failed part way
+                #can leave its optimizer log there (a worker reads back and removes the log it finishes)
+                if os.path.exists(task[9]):
+                    os.remove(task[9])
+                if error is not None:
+                    raise error
+                queue.record(i, rnd, rep, task, outcome)
+            
+            #record replicates that were claimed longer ago than the timeout
+            if timeout is not None:
+                #claimed files are named {key}.{worker}.task
+                for claim in sorted(os.listdir(dirs["claimed"])):
+                    key = claim.split(".")[0]
+                    try:
+                        claimed_at = os.path.getmtime(os.path.join(dirs["claimed"], claim))
+                    except OSError:
+                        #finished in the meantime
+                        continue
+                    if key in published and time.time() - claimed_at > timeout:
+                        i, rnd, rep, task = published.pop(key)
+                        queue.record(i, rnd, rep, task, ReplicateTimeout("replicate ran for more than {} seconds".format(timeout)))
+            
+            #withdraw replicates of rounds that were stopped early, if no worker claimed them yet
+            for key in sorted(published):
+                i, rnd, rep, task = published[key]
+                if runs[i].finished or rnd != runs[i].round:
+                    del published[key]
+                    try:
+                        os.remove(os.path.join(dirs["tasks"], key + ".task"))
+                    except OSError:
+                        pass
+                    if os.path.exists(task[9]):
+                        os.remove(task[9])
+            
+            if not found and (queue.waiting or published):
+                time.sleep(poll)
+    finally:
+        #take back replicates nobody claimed, so workers do not run them for nothing
+        for key in published:
+            try:
+                os.remove(os.path.join(dirs["tasks"], key + ".task"))
+            except OSError:
+                pass
+
+def run_queue_worker(queue_dir, poll=1.0, max_idle=None, max_tasks=None):
+    #--------------------------------------------------------------------------------------
+    # claim and run replicates from a shared-filesystem work queue (see run_schedule_queue),
+    # returns the number of replicates run
+    # a task is claimed by renaming it into claimed/, which only one worker can do, and its outcome
+    # (or error) is written to results/. The worker stops once a file named "stop" is in the queue
+    # folder, after max_idle seconds without work, or after max_tasks replicates.
+    # The model functions of the tasks must be importable by the worker.
+    
+    # Arguments
+    # queue_dir: the shared queue folder
+    # poll: seconds to wait between looks at the tasks folder
+    # max_idle: seconds without work before the worker stops (None to keep waiting)
+    # max_tasks: number of replicates to run before the worker stops (None for no limit)
+    #--------------------------------------------------------------------------------------
+    dirs = queue_dirs(queue_dir)
+    worker = "{0}-{1}".format(socket.gethostname(), os.getpid())
+    done = 0
+    idle_since = time.time()
+    while max_tasks is None or done < max_tasks:
+        if os.path.exists(os.path.join(queue_dir, "stop")):
+            break
+        claimed = None
+        for fname in sorted(f for f in os.listdir(dirs["tasks"]) if f.endswith(".task")):
+            key = fname[:-len(".task")]
+            claimname = os.path.join(dirs["claimed"], "{0}.{1}.task".format(key, worker))
+            try:
+                os.rename(os.path.join(dirs["tasks"], fname), claimname)
+            except OSError:
+                #another worker claimed it (or the coordinator withdrew it)
+                continue
+            #the claim time is the modification time of the claimed file
+            os.utime(claimname, None)
+            claimed = (key, fname, claimname)
+            break
+        if claimed is None:
+            if max_idle is not None and time.time() - idle_since > max_idle:
+                break
+            time.sleep(poll)
+            continue
+        
+        key, fname, claimname = claimed
+        try:
+            with open(claimname, 'rb') as fh:
+                task = pickle.load(fh)
+            try:
+                outcome, error = run_replicate(task), None
+            except Exception as e:
+                outcome, error = None, e
+        except KeyboardInterrupt:
+            #put the replicate back for another worker
+            os.rename(claimname, os.path.join(dirs["tasks"], fname))
+            raise
+        try:
+            pickle.dumps(error, protocol=2)
+        except Exception:
+            error = RuntimeError(repr(error))
+        publish_file(os.path.join(dirs["results"], key + ".result"), (outcome, error), dirs["tmp"])
+        os.remove(claimname)
+        done += 1
+        idle_since = time.time()
+    return done
+
+#modules every worker of a kept pool imports before it starts
+PRELOAD_MODULES = ["numpy", "scipy.optimize", "moments", __name__]
+
+#pools and executors kept open for the session, by (kind, workers), see keep_pool in Optimize_Routine
+_session_pools = {}
+
+def pool_context(preload=()):
+    #--------------------------------------------------------------------------------------
+    # return a multiprocessing context whose processes are forked from a forkserver that has
+    # already imported PRELOAD_MODULES and preload (ex. the model modules), so a new worker
+    # does not import moments again; falls back to multiprocessing itself where there is no
+    # forkserver (Python 2.7, Windows). The preloaded modules are fixed once the forkserver runs.
+    #--------------------------------------------------------------------------------------
+    if not hasattr(multiprocessing, "get_context") or "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(PRELOAD_MODULES + [m for m in preload if m not in PRELOAD_MODULES])
+    return context
+
+def model_modules(runs):
+    # names of the modules the model functions of a list of ModelRuns come from (wrapped ones too)
+    modules = []
+    for run in runs:
+        for func in (run.func, getattr(run.func, "func", None)):
+            name = getattr(func, "__module__", None)
+            if name and name != "__main__" and name not in modules:
+                modules.append(name)
+    return modules
+
+def session_pool(kind, workers, preload=()):
+    #--------------------------------------------------------------------------------------
+    # return the pool ("pool") or executor ("executor") with `workers` processes kept open for
+    # the session, starting it from a preloaded forkserver the first time; a kept pool of
+    # another kind or size is closed first, so the session never holds more than one
+    #--------------------------------------------------------------------------------------
+    key = (kind, int(workers))
+    if key not in _session_pools:
+        close_pool()
+        context = pool_context(preload)
+        if kind == "executor":
+            _session_pools[key] = concurrent.futures.ProcessPoolExecutor(max_workers=int(workers), mp_context=context)
+        else:
+            _session_pools[key] = context.Pool(processes=int(workers))
+    return _session_pools[key]
+
+def close_pool():
+    # close the pool kept open with keep_pool, if any (this also happens when python exits)
+    for key, pool in list(_session_pools.items()):
+        if key[0] == "executor":
+            pool.shutdown(wait=True)
+        else:
+            pool.terminate()
+            pool.join()
+        del _session_pools[key]
+
+atexit.register(close_pool)
+
+def start_pool(workers, timeout=None, keep=False, preload=()):
+    #--------------------------------------------------------------------------------------
+    # start a process pool if replicates should run in parallel, returns None for a single worker
+    # with a timeout every replicate runs in its own process (even for a single worker) so it can be killed
+    
+    # Arguments
+    # workers: number of worker processes
+    # timeout: seconds a replicate may run before it is killed (None for no limit)
+    # keep: reuse the pool kept open for the session (see session_pool), and start the
+    #       processes of a KillablePool from a preloaded forkserver
+    # preload: module names for the forkserver to import, see pool_context
+    #--------------------------------------------------------------------------------------
+    workers = int(workers)
+    if timeout is not None:
+        return KillablePool(processes=workers, timeout=timeout, context=pool_context(preload) if keep else None)
+    if workers > 1 and keep:
+        return session_pool("pool", workers, preload)
+    if workers > 1:
+        return multiprocessing.Pool(processes=workers)
+    return None
+
+def stop_pool(pool):
+    #shut down the process pool once all rounds are done (or the routine was interrupted)
+    #a pool kept for the session stays open for the next routine
+    if pool is not None and pool not in _session_pools.values():
+        pool.terminate()
+        pool.join()
+
+def run_models(runs, workers=1, timeout=None, scheduler="pool", progress=None, queue_dir=None, keep_pool=False):
+    #--------------------------------------------------------------------------------------
+    # run a list of ModelRuns with the chosen scheduler, see Optimize_Routine for the arguments
+    # when replicates run in other processes, the spectrum is handed to them as SharedSpectrum files
+    # instead of being pickled into every task
+    #--------------------------------------------------------------------------------------
+    if scheduler not in ("pool", "asyncio", "queue"):
+        raise ValueError("Unknown scheduler, use 'pool', 'asyncio' or 'queue': {}".format(scheduler))
+    if scheduler == "queue" and queue_dir is None:
+        raise ValueError("scheduler='queue' needs a shared queue folder: queue_dir")
+    if scheduler == "asyncio" and timeout is not None:
+        raise ValueError("A replicate timeout is only supported by scheduler='pool'")
+    reporter = None
+    if progress is not None:
+        reporter = ProgressReporter(runs, workers, progress)
+    
+    share_dir = None
+    if scheduler == "queue":
+        share_dir = queue_dirs(queue_dir)["spectra"]
+    elif int(workers) > 1 or timeout is not None:
+        share_dir = tempfile.mkdtemp(prefix="moments_fs_")
+    if share_dir is not None:
+        for run in runs:
+            run.share(share_dir)
+    try:
+        if scheduler == "queue":
+            run_schedule_queue(runs, queue_dir, timeout, reporter)
+        elif scheduler == "asyncio":
+            run_schedule_async(runs, int(workers), reporter, keep_pool, model_modules(runs))
+        else:
+            pool = start_pool(workers, timeout, keep_pool, model_modules(runs))
+            try:
+                run_schedule(runs, pool, int(workers), reporter)
+            finally:
+                stop_pool(pool)
+    finally:
+        for run in runs:
+            run.unshare()
+        if share_dir is not None and scheduler != "queue":
+            os.rmdir(share_dir)
 
 def Optimize_Routine(fs, outfile, model_name, func, rounds, param_number, fs_folded=True,
                          reps=None, maxiters=None, folds=None, in_params=None,
-                         in_upper=None, in_lower=None, param_labels=" "):
+                         in_upper=None, in_lower=None, param_labels=" ", workers=1,
+                         checkpoint=False, resume=False, converge_reps=None, converge_tol=0.1,
+                         timeout=None, results_store="text", instrument=False, elite=None, elite_dist=0.1,
+                         scheduler="pool", progress=None, projections=None, queue_dir=None, keep_pool=False):
     #--------------------------------------------------------------------------------------
     # Mandatory Arguments =
     #(1) fs:  spectrum object name
@@ -201,94 +1956,113 @@ def Optimize_Routine(fs, outfile, model_name, func, rounds, param_number, fs_fol
     #(12) in_upper: a list of upper bound values
     #(13) in_lower: a list of lower bound values
     #(14) param_labels: list of labels for parameters that will be written to the output file to keep track of their order
+    #(15) workers: number of processes used to run the replicates of a round at the same time. Default is 1 (serial).
+    #     Starting parameters are always perturbed in the main process and results are written
+    #     in replicate order, so the output does not depend on the number of workers.
+    #(16) checkpoint: A Boolean value. If True, the state of the routine is saved to "{outfile}.{model_name}.checkpoint.pkl"
+    #     after every replicate. Default is False.
+    #(17) resume: A Boolean value. If True and a checkpoint file exists, the finished replicates are loaded from it
+    #     and the routine continues where it stopped. Output written after the last checkpoint is removed from
+    #     the results and log files first, as those replicates run again. Implies checkpoint=True. Default is False.
+    #(18) converge_reps: early stopping. If set, a round stops once this many of its replicates are within
+    #     converge_tol of the best log-likelihood so far, and the remaining rounds are skipped once a round
+    #     improves the best log-likelihood by no more than converge_tol. Every stop is noted in the
+    #     results file on a line starting with '#'. Default is None (always run every replicate).
+    #(19) converge_tol: log-likelihood tolerance used by converge_reps. Default is 0.1.
+    #(20) timeout: time budget for a single replicate, in seconds. A replicate that runs longer is killed
+    #     and noted in the results file as timed out with its starting parameters, and the rest of the
+    #     round keeps going. Replicates then run in their own processes. Default is None (no limit).
+    #(21) results_store: "text" writes every replicate to "{outfile}.{model_name}.optimized.txt" as it finishes.
+    #     "sqlite" writes them in batches to "{outfile}.{model_name}.optimized.sqlite" (see ResultsStore),
+    #     and the .optimized.txt file is exported from it once the model is finished. Default is "text".
+    #(22) instrument: A Boolean value. If True, the time spent in each phase of every replicate (steady state,
+    #     each split, integrate by number of populations, model calls, optimization, scoring and log I/O)
+    #     is counted and written as one JSON line per replicate to "{outfile}.{model_name}.phases.jsonl".
+    #     Nothing is timed when False. Default is False.
+    #(23) elite: size of the elite pool. If set, every round after the first starts its replicates from up to
+    #     this many of the best distinct parameter sets found so far (taking turns, best first) instead of
+    #     only the single best one, which keeps high-dimensional models from collapsing on one optimum early.
+    #     Default is None (every replicate starts from the best parameter set).
+    #(24) elite_dist: minimum distance between parameter sets in the elite pool, as the root mean square of
+    #     their log10 differences. Default is 0.1.
+    #(25) scheduler: "pool" runs the replicates in a multiprocessing pool (or in this process for a single worker).
+    #     "asyncio" dispatches them from an asyncio event loop to executor workers and records each one as its
+    #     completion event arrives (Python 3 only, not with a timeout). "queue" hands them to workers on other
+    #     nodes through a shared folder, see queue_dir. All give the same output. Default is "pool".
+    #(26) progress: a function called with a status dictionary after every replicate, or the name of a small JSON
+    #     status file that is replaced in one step after every replicate. The status has the completed/total
+    #     replicates of every model's current round, the best log-likelihood, the mean replicate time and an
+    #     estimate of the time left (see ProgressReporter). Default is None (no progress reports).
+    #(27) projections: coarse-to-fine optimization. A list with, for each round, the sample sizes (one per population)
+    #     to project the spectrum to with fs.project, or None to use the full spectrum, ex. [[10,10,10], [16,16,16], None].
+    #     The replicates of a projected round are optimized against the smaller spectrum, which is much cheaper to
+    #     simulate, and their optimized parameters are then scored against the full spectrum, so every written
+    #     log-likelihood, AIC and theta is at full resolution and the next round starts from the best of them.
+    #     The last round(s) should use the full spectrum. Default is None (every round uses the full spectrum).
+    #(28) queue_dir: with scheduler="queue", the replicates are published as task files in this folder on a shared
+    #     filesystem and run by worker processes on any node (started with Queue_Worker.py, see run_queue_worker),
+    #     while this process gathers the results and seeds the next rounds. workers is then only used to estimate
+    #     the time left, and timeout applies from the moment a worker claims a replicate. Default is None.
+    #(29) keep_pool: A Boolean value. If True, the worker processes are started from a forkserver that has already
+    #     imported moments and the model modules, and the pool stays open after the routine, so later calls with
+    #     the same number of workers (other models, or more rounds) reuse it instead of starting new processes.
+    #     With a timeout, every replicate still gets its own process, forked from the preloaded forkserver.
+    #     Model functions must then be importable from a module (not defined in an interactive session).
+    #     Call close_pool() to close it early. Default is False (a new pool for every call).
     #--------------------------------------------------------------------------------------
+    run = ModelRun(fs, outfile, model_name, func, rounds, param_number, fs_folded=fs_folded,
+                       reps=reps, maxiters=maxiters, folds=folds, in_params=in_params,
+                       in_upper=in_upper, in_lower=in_lower, param_labels=param_labels,
+                       checkpoint=checkpoint, resume=resume,
+                       converge_reps=converge_reps, converge_tol=converge_tol, results_store=results_store,
+                       instrument=instrument, elite=elite, elite_dist=elite_dist, projections=projections)
+    run_models([run], workers, timeout, scheduler, progress, queue_dir, keep_pool)
 
-    #call function that determines if our params and bounds have been set or need to be generated for us
-    params, upper_bound, lower_bound = parse_params(param_number, in_params, in_upper, in_lower)
-
-    #call function that determines if our replicates, maxiter, and fold have been set or need to be generated for us
-    reps_list, maxiters_list, folds_list = parse_opt_settings(rounds, reps, maxiters, folds)
+def Optimize_Batch(fs, outfile, models, rounds, fs_folded=True, reps=None, maxiters=None,
+                       folds=None, workers=1, checkpoint=False, resume=False, converge_reps=None,
+                       converge_tol=0.1, timeout=None, results_store="text", instrument=False,
+                       elite=None, elite_dist=0.1, scheduler="pool", progress=None, projections=None,
+                       queue_dir=None, keep_pool=False):
+    #--------------------------------------------------------------------------------------
+    # run the optimization routine for a whole set of models as one job
+    # the replicates of all models share one pool of workers and are handed out cheapest
+    # model first (by number of parameters); each model moves to its next round as soon as
+    # its own round is finished, so cores do not sit idle while one slow model finishes
+    # a round. Each model gets its own random number state (drawn from numpy's global one
+    # in the order the models are listed), so the results do not depend on scheduling.
     
-    print("\n\n============================================================================\nModel {}\n============================================================================".format(model_name))
-
-    #start keeping track of time it takes to complete optimizations for this model
-    tb_round = datetime.now()
+    # Mandatory Arguments =
+    #(1) fs:  spectrum object name
+    #(2) outfile:  prefix for output naming
+    #(3) models: a list of (model_name, func, param_number, param_labels) tuples, ex.
+    #     [("sim_split_no_mig", Models_3D.sim_split_no_mig, 4, "nu1, nu2, nu3, T1"), ...]
+    #(4) rounds: number of optimization rounds to perform
+    
+    # Optional Arguments =
+    #(5) fs_folded, reps, maxiters, folds, workers, checkpoint, resume, converge_reps, converge_tol, timeout,
+    #     results_store, instrument, elite, elite_dist, scheduler, progress, projections, queue_dir, keep_pool:
+    #     as in Optimize_Routine,
+    #     the same settings are used for every model
+    #--------------------------------------------------------------------------------------
+    #draw a seed for every model in list order before anything else uses the random numbers
+    seeds = [numpy.random.randint(0, 2**31 - 1) for model in models]
     
-    # We need an output file that will store all summary info for each replicate, across rounds
-    outname = "{0}.{1}.optimized.txt".format(outfile,model_name)
-    with open(outname, 'a') as fh_out:
-        fh_out.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params({})\n".format(param_labels))
+    print("\n\n============================================================================\n"
+              "Batch of {0} models on {1} worker(s)\n"
+              "============================================================================".format(len(models), int(workers)))
+    tb_batch = datetime.now()
     
-    #Create list to store sublists of [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values] for every replicate
-    results_list = []
+    runs = []
+    for (model_name, func, param_number, param_labels), seed in zip(models, seeds):
+        runs.append(ModelRun(fs, outfile, model_name, func, rounds, param_number, fs_folded=fs_folded,
+                                 reps=reps, maxiters=maxiters, folds=folds, param_labels=param_labels,
+                                 checkpoint=checkpoint, resume=resume,
+                                 rng_state=numpy.random.RandomState(seed).get_state(),
+                                 converge_reps=converge_reps, converge_tol=converge_tol, results_store=results_store,
+                                 instrument=instrument, elite=elite, elite_dist=elite_dist,
+                                 projections=projections))
+    run_models(runs, workers, timeout, scheduler, progress, queue_dir, keep_pool)
     
-    #for every round, execute the assigned number of replicates with other round-defined args (maxiter, fold, best_params)
-    rounds = int(rounds)
-    for r in range(rounds):
-        print("\tBeginning Optimizations for Round {}:".format(r+1))
-       
-        #make sure first round params are assigned (either user input or auto generated)
-        if r == int(0):
-            best_params = params
-        #and that all subsequent rounds use the params from a previous best scoring replicate
-        else:
-            best_params = results_list[0][5]
-
-        #perform an optimization routine for each rep number in this round number
-        for rep in range(1, (reps_list[r]+1) ):
-            print("\t\tRound {0} Replicate {1} of {2}:".format(r+1, rep, (reps_list[r])))
-            
-            #keep track of start time for rep
-            tb_rep = datetime.now()
-            
-            #perturb starting parameters
-            params_perturbed = moments.Misc.perturb_params(best_params, fold=folds_list[r],
-                                                               upper_bound=upper_bound, lower_bound=lower_bound)
-            print("\t\t\tStarting parameters = [{}]".format(", ".join([str(numpy.around(x, 6)) for x in params_perturbed])))
-            #optimize from perturbed parameters
-            params_opt = moments.Inference.optimize_log_fmin(params_perturbed, fs, func,
-                                                                 lower_bound=lower_bound, upper_bound=upper_bound,
-                                                                 verbose=1, maxiter=maxiters_list[r],
-                                                                 output_file = "{}.log.txt".format(model_name))
-            print("\t\t\tOptimized parameters =[{}]".format(", ".join([str(numpy.around(x, 6)) for x in params_opt])))
-
-            #simulate the model with the optimized parameters
-            sim_model = func(params_opt, fs.sample_sizes)
-
-            #collect results into a list using function above - [roundnum_repnum, log-likelihood, AIC, chi^2 test stat, theta, parameter values]
-            roundrep = "Round_{0}_Replicate_{1}".format(r+1, rep)
-            rep_results = collect_results(fs, sim_model, params_opt, roundrep, fs_folded)
-            
-            #reproduce replicate log to bigger log file, because constantly re-written
-            write_log(outfile, model_name, rep_results, roundrep)
-            
-            #append results from this sim to larger list
-            results_list.append(rep_results)
-            
-            #write all this info to our main results file
-            with open(outname, 'a') as fh_out:
-                #join the param values together with commas
-                easy_p = ",".join(str(numpy.around(x, 4)) for x in rep_results[5])
-                fh_out.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n".format(model_name, rep_results[0],
-                                                                              rep_results[1], rep_results[2],
-                                                                              rep_results[3], rep_results[4],
-                                                                              easy_p))
-
-            #calculate elapsed time for replicate
-            tf_rep = datetime.now()
-            te_rep = tf_rep - tb_rep
-            print("\n\t\t\tReplicate time: {0} (H:M:S)\n".format(te_rep))
-
-        #Now that this round is over, sort results in order of likelihood score
-        #we'll use the parameters from the best rep to start the next round as the loop continues
-        results_list.sort(key=lambda x: float(x[1]), reverse=True)
-        print("\tBest so far: {0}, ll = {1}\n\n".format(results_list[0][0], results_list[0][1]))
-
-    #Now that all rounds are over, calculate elapsed time for the whole model
-    tf_round = datetime.now()
-    te_round = tf_round - tb_round
-    print("\n{0} Analysis Time for Model: {1} (H:M:S)\n\n"
-              "============================================================================".format(model_name, te_round))
-    
-    #cleanup temp log file
-    os.remove("{}.log.txt".format(model_name))
+    tf_batch = datetime.now()
+    print("\nAnalysis Time for Batch: {0} (H:M:S)\n\n"
+              "============================================================================".format(tf_batch - tb_batch))
@@ -0,0 +1,58 @@
+'''
+usage: python Queue_Worker.py [shared queue folder] [--path DIR ...] [--processes N]
+                              [--poll 1] [--max-idle SECONDS] [--max-tasks N]
+example: python Queue_Worker.py /scratch/dan/queue --path ./ 3D_Models --processes 16 --max-idle 600
+Runs replicates published to a shared queue folder by Optimize_Routine or Optimize_Batch
+with scheduler="queue" and queue_dir set to the same folder. Start it on every node that
+should take part (for example from a job array); each worker claims one replicate at a
+time, cheapest model first, runs it and writes its outcome back for the coordinator.
+The model functions must be importable by the workers, so add the folders holding the
+model scripts (ex. Models_3D.py) with --path. Workers stop once the file "stop" exists
+in the queue folder, after --max-idle seconds without work, or after --max-tasks replicates
+(per process). On one machine, start a coordinator in one terminal and the workers in
+another to try it out.
+-------------------------
+Written for Python 2.7 and 3.7
+Python modules required:
+  -Numpy
+  -Scipy
+  -moments
+-------------------------
+'''
+
+import sys
+import os
+import argparse
+import multiprocessing
+
+def main():
+    parser = argparse.ArgumentParser(description="Run replicates from a shared-filesystem work queue.")
+    parser.add_argument("queue_dir", help="shared queue folder")
+    parser.add_argument("--path", nargs="+", default=[], help="folders to import the model scripts from")
+    parser.add_argument("--processes", type=int, default=1, help="number of worker processes on this node")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between looks at the queue")
+    parser.add_argument("--max-idle", type=float, help="stop after this many seconds without work")
+    parser.add_argument("--max-tasks", type=int, help="stop after this many replicates per process")
+    args = parser.parse_args()
+
+    #the model scripts (and Optimize_Functions) have to be importable to unpickle the tasks
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:0] = [os.path.abspath(p) for p in args.path] + [here]
+    import Optimize_Functions
+
+    worker_args = (args.queue_dir, args.poll, args.max_idle, args.max_tasks)
+    if args.processes == 1:
+        done = Optimize_Functions.run_queue_worker(*worker_args)
+        print("\nWorker finished after {} replicates\n".format(done))
+        return
+    processes = [multiprocessing.Process(target=Optimize_Functions.run_queue_worker, args=worker_args)
+                     for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print("\n{} workers finished\n".format(args.processes))
+
+#===========================================================================
+if __name__ == "__main__":
+    main()
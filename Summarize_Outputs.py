@@ -1,5 +1,5 @@
 '''
-usage: python Summarize_Outputs.py [full path to directory with results files]
+usage: python Summarize_Outputs.py [full path to directory with results files] [--incremental] [--workers N]
 example: python Summarize_Outputs.py users/dan/moments_analyses/results/
 The purpose of this script is to make sense of the results files
 that are produced after optimizations have been run on multiple
@@ -14,6 +14,16 @@ Two summary files will be produced:
     top scoring replicate per model and it is already sorted in order of AIC.
 You should probably inspect that the top-scoring replicates were ERROR-FREE. 
 Often errors are logged on screen and log-likelihoods are still produced.
+The files are read one line at a time and only the best replicates are kept
+(a bounded heap per model), so memory does not grow with the size of the files.
+With --incremental, the byte offset reached in every file is stored in
+Results_Summary_Index.json (with the best replicates found so far), and the next
+run only parses rows appended since then. This is handy for summarizing while
+optimizations are still running. With --workers N, files are parsed by N processes.
+The summary files are replaced in one step on every run, never appended to.
+The same summary can be made from python:
+    import Summarize_Outputs
+    summary_list, simple_list = Summarize_Outputs.summarize_outputs("results/")
 -------------------------
 Written for Python 2.7 and 3.7
 No dependencies
@@ -24,63 +34,218 @@ https://github.com/dportik
 Updated September 2019
 '''
 
-import sys
 import os
+import heapq
+import json
+import uuid
+import argparse
+import itertools
+import multiprocessing
 
-#===========================================================================
-file_dir = sys.argv[1]
-os.chdir(file_dir)
-
-#initiate empty lists that we will fill with summary information
-summary_list = []
-simple_list = []
-
-#list comprehension to find output files
-flist = sorted([f for f in os.listdir('.') if f.endswith(".optimized.txt")])
-print("\n\nFound {} output files to summarize.\n".format(len(flist)))
-
-#iterate over output files
-for f in flist:
-    content = []
-    print("\tExtracting contents from: {}".format(f))
-    #open file, skip first line
-    with open(f, 'r') as fh:
-        next(fh)
-        #split lines and add contents to list
+def parse_line(line):
+    #--------------------------------------------------------------------------------------
+    # split a line of an .optimized.txt file on tabs, returns None for lines that are not
+    # replicates (blank lines and notes starting with '#')
+    #--------------------------------------------------------------------------------------
+    if line.startswith('#') or not line.strip():
+        return None
+    return line.strip().split('\t')
+
+def read_rows(fname):
+    #--------------------------------------------------------------------------------------
+    # lazily yield the rows of an .optimized.txt file, split on tabs, in the order
+    #"Model"	"Replicate"	"log-likelihood"	"AIC"	"chi-squared"	"theta"	"optimized_params(xxx)"
+    # the header line, blank lines and notes (lines starting with '#') are skipped
+    
+    # Arguments
+    # fname: name of the results file
+    #--------------------------------------------------------------------------------------
+    with open(fname, 'r') as fh:
+        #skip first line
+        next(fh, None)
         for line in fh:
-            content.append(line.strip().split('\t'))
-    #content list items will have order: "Model"	"Replicate"	"log-likelihood"	"AIC"	"chi-squared"	"theta"	"optimized_params(xxx)"
-    #let's sort all the rows by AIC, lowest to highest
-    content.sort(key=lambda x: float(x[3]))
+            row = parse_line(line)
+            if row is not None:
+                yield row
+
+def top_rows(rows, top=5):
+    #--------------------------------------------------------------------------------------
+    # return the `top` rows with the lowest AIC, lowest first, keeping only a heap of
+    # `top` rows in memory (rows with equal AIC stay in file order)
+    
+    # Arguments
+    # rows: an iterable of split rows, ex. read_rows(fname)
+    # top: number of rows to keep
+    #--------------------------------------------------------------------------------------
+    return heapq.nsmallest(top, rows, key=lambda x: float(x[3]))
+
+def read_new_rows(fh, consumed):
+    #--------------------------------------------------------------------------------------
+    # yield the rows of a results file opened in binary mode, from its current position,
+    # keeping consumed[0] at the byte offset after the last complete line read
+    # (the header line at offset 0 is skipped)
+    #--------------------------------------------------------------------------------------
+    for line in fh:
+        if not line.endswith(b"\n"):
+            break
+        if consumed[0] > 0:
+            row = parse_line(line.decode())
+            if row is not None:
+                yield row
+        consumed[0] += len(line)
+
+def scan_file(job):
+    #--------------------------------------------------------------------------------------
+    # bring the index entry of one results file up to date, returns the new entry =
+    # {"size", "mtime": of the file when it was read, "offset": bytes already parsed,
+    #  "tail": the last bytes before offset, "top": top setting, "rows": the `top` best rows}
+    # with a previous entry only the lines appended after its offset are parsed; the file is
+    # read again from the start if it shrank, its tail changed, or `top` is different.
+    # A last line without a newline is still being written and is left for the next scan.
+    # This is a module-level function so that it can be sent to a process pool.
+    
+    # Arguments
+    # job: a tuple of (fname, entry, top), entry is the previous index entry or None
+    #--------------------------------------------------------------------------------------
+    fname, entry, top = job
+    stat = os.stat(fname)
+    if (entry is not None and entry["top"] == top and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime):
+        #nothing new since the last scan
+        return entry
+    
+    offset, rows = 0, []
+    with open(fname, 'rb') as fh:
+        if entry is not None and entry["top"] == top and stat.st_size >= entry["offset"]:
+            fh.seek(max(0, entry["offset"] - len(entry["tail"])))
+            if fh.read(len(entry["tail"])).decode('latin-1') == entry["tail"]:
+                offset, rows = entry["offset"], entry["rows"]
+        fh.seek(offset)
         
-    #add top five entries to summary list
-    for i in content[:5]:
-        summary_list.append(i)
+        #merge the kept rows (from earlier in the file) with the new ones
+        consumed = [offset]
+        rows = top_rows(itertools.chain(rows, read_new_rows(fh, consumed)), top)
+        offset = consumed[0]
+        fh.seek(max(0, offset - 64))
+        tail = fh.read(offset - max(0, offset - 64)).decode('latin-1')
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "offset": offset,
+                "tail": tail, "top": top, "rows": rows}
+
+def replace_file(fname, text):
+    #--------------------------------------------------------------------------------------
+    # write text to a uniquely named temporary file next to fname, flush it to disk and move
+    # it into place, so readers never see a half-written file (the same steps as
+    # Optimize_Functions.atomic_write, which is not imported to keep this script free of dependencies)
+    #--------------------------------------------------------------------------------------
+    tempname = os.path.join(os.path.dirname(os.path.abspath(fname)),
+                                "{0}.{1}.tmp".format(os.path.basename(fname), uuid.uuid4().hex))
+    try:
+        with open(tempname, 'w') as fh:
+            fh.write(text)
+            fh.flush()
+            os.fsync(fh.fileno())
+        getattr(os, "replace", os.rename)(tempname, fname)
+    except BaseException:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise
+
+def summarize_outputs(file_dir, top=5, incremental=False, workers=1):
+    #--------------------------------------------------------------------------------------
+    # summarize every .optimized.txt file in a directory, returns two lists of rows =
+    # summary_list: the `top` replicates of every results file
+    # simple_list: the best replicate of every results file, sorted by AIC
+    
+    # Arguments
+    # file_dir: directory with the results files
+    # top: number of replicates to keep for every results file
+    # incremental: if True, keep an index (Results_Summary_Index.json) of how far every
+    #              file has been parsed, so later runs only parse newly appended rows
+    # workers: number of processes used to parse files at the same time
+    #--------------------------------------------------------------------------------------
+    #initiate empty lists that we will fill with summary information
+    summary_list = []
+    #a heap of (AIC, file order, row) holding the best replicate of every model
+    simple_heap = []
+
+    #list comprehension to find output files
+    flist = sorted([f for f in os.listdir(file_dir) if f.endswith(".optimized.txt")])
+    print("\n\nFound {} output files to summarize.\n".format(len(flist)))
+    
+    #load how far every file was parsed in an earlier run
+    indexname = os.path.join(file_dir, "Results_Summary_Index.json")
+    index = {}
+    if incremental and os.path.exists(indexname):
+        with open(indexname, 'r') as fh:
+            index = json.load(fh)
+    
+    #parse the files (only their new rows when incremental), in parallel if asked
+    jobs = [(os.path.join(file_dir, f), index.get(f), top) for f in flist]
+    if int(workers) > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=min(int(workers), len(jobs)))
+        try:
+            entries = pool.map(scan_file, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        entries = [scan_file(job) for job in jobs]
+
+    #iterate over output files
+    for i, (f, entry) in enumerate(zip(flist, entries)):
+        print("\tExtracting contents from: {}".format(f))
+        #the top entries, sorted by AIC, lowest to highest
+        content = entry["rows"]
+        if not content:
+            print("\t\tNo replicates found, skipping.")
+            continue
         
-    #add top entry to easy list
-    simple_list.append(content[0])
+        #add top entries to summary list
+        summary_list.extend(content)
+        
+        #add top entry to easy list
+        heapq.heappush(simple_heap, (float(content[0][3]), i, content[0]))
    
-#sort the list containing only the top entry for each model by order of AIC
-simple_list.sort(key=lambda x: float(x[3]))
-
-#create output file 1
-out1 = "Results_Summary_Extended.txt"
-with open(out1, 'a') as fh:
-    #write tab-delimited file with extended results
-    fh.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n")
-    for row in summary_list:
-        for val in row:
-            fh.write("{}\t".format(val))
-        fh.write("\n")
-
-#create output file 2
-out2 = "Results_Summary_Short.txt"
-with open(out2, 'a') as fh:
-    #write tab-delimited file with simplified results
-    fh.write("Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n")
-    for row in simple_list:
-        for val in row:
-            fh.write("{}\t".format(val))
-        fh.write("\n")
-
-print("\n\nSummary files '{0}' and '{1}' have been written to: \n\t{2}\n\n".format(out1, out2, file_dir))
+    #the list containing only the top entry for each model, in order of AIC
+    simple_list = [heapq.heappop(simple_heap)[2] for x in range(len(simple_heap))]
+    
+    if incremental:
+        replace_file(indexname, json.dumps(dict(zip(flist, entries))))
+    
+    return summary_list, simple_list
+
+def write_summary(fname, rows):
+    #--------------------------------------------------------------------------------------
+    # write a tab-delimited summary file, replacing any earlier version in one step
+    
+    # Arguments
+    # fname: name of the summary file
+    # rows: list of split rows to write
+    #--------------------------------------------------------------------------------------
+    lines = ["Model\tReplicate\tlog-likelihood\tAIC\tchi-squared\ttheta\toptimized_params\n"]
+    for row in rows:
+        lines.append("".join("{}\t".format(val) for val in row) + "\n")
+    replace_file(fname, "".join(lines))
+
+def main(file_dir, incremental=False, workers=1):
+    summary_list, simple_list = summarize_outputs(file_dir, incremental=incremental, workers=workers)
+
+    #create output file 1 with extended results
+    out1 = "Results_Summary_Extended.txt"
+    write_summary(os.path.join(file_dir, out1), summary_list)
+
+    #create output file 2 with simplified results
+    out2 = "Results_Summary_Short.txt"
+    write_summary(os.path.join(file_dir, out2), simple_list)
+
+    print("\n\nSummary files '{0}' and '{1}' have been written to: \n\t{2}\n\n".format(out1, out2, file_dir))
+
+#===========================================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the .optimized.txt files in a directory.")
+    parser.add_argument("file_dir", help="full path to directory with results files")
+    parser.add_argument("--incremental", action="store_true",
+                            help="only parse rows added since the last incremental run")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to parse files")
+    args = parser.parse_args()
+    main(args.file_dir, incremental=args.incremental, workers=args.workers)